@@ -21,16 +21,154 @@ import logging
 import ochopod
 import os
 import redis
+import store
 import sys
+import time
+import zlib
 
+from bisect import bisect
 from flask import Flask, request
 from ochopod.core.fsm import diagnostic
-from random import choice
+from random import shuffle
 
 logger = logging.getLogger('ochopod')
 
 web = Flask(__name__)
 
+#: Priority lanes from the highest to the lowest (the slaves drain them in weighted order).
+LANES = ['high', 'normal', 'low']
+
+#: Seconds after which a build still pending is assumed lost (its key can then be queued again).
+STALE = 3 * 3600
+
+#: How much more loaded (in builds per slave) its current cluster must be before a repository is moved to another one.
+MARGIN = 2.0
+
+
+def _unpack(blob):
+    """
+    Decompresses and deserializes a build log as stored by the slaves. Logs recorded before they were compressed
+    are plain JSON.
+
+    :type blob: str
+    :param blob: the stored log
+    :rtype: list
+    """
+
+    try:
+        return json.loads(zlib.decompress(blob))
+    except zlib.error:
+        return json.loads(blob)
+
+
+def _queue(cluster, qid, lane):
+    """
+    Formats the name of the redis list backing a given priority lane for a given slave. Note the normal lane is
+    using the original queue name.
+
+    :type cluster: str
+    :type qid: int
+    :type lane: str
+    :param cluster: the slave cluster
+    :param qid: the slave index
+    :param lane: the priority lane
+    :rtype: str
+    """
+
+    return 'queue-%s-%d' % (cluster, qid) if lane == 'normal' else 'queue-%s-%d-%s' % (cluster, qid, lane)
+
+
+class Ring():
+    """
+    Consistent hash ring mapping repositories onto the slaves of a given cluster. Each slave index is given a set of
+    virtual nodes spread on the ring. Adding or removing a slave will therefore only remap about 1/N of the
+    repositories (and preserve their cached checkouts).
+    """
+
+    #: Number of virtual nodes per slave.
+    replicas = 64
+
+    def __init__(self, size):
+
+        tokens = [(index, n) for index in range(size) for n in range(self.replicas)]
+        self.nodes = sorted((self._hash('%d#%d' % token), token[0]) for token in tokens)
+        self.points = [point for point, _ in self.nodes]
+
+    @staticmethod
+    def _hash(key):
+
+        #
+        # - don't use the built-in hash() which is not guaranteed to be stable across platforms & processes
+        #
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def pick(self, key):
+        """
+        Picks the slave index to use for the specified key.
+
+        :type key: str
+        :param key: the repository tag
+        :rtype: int
+        """
+
+        return self.nodes[bisect(self.points, self._hash(key)) % len(self.nodes)][1]
+
+
+class Index():
+    """
+    Capability index matching capability strings (e.g docker+sbt) against the slave clusters, which are named
+    slave-[<token>]* where each token is a capability. Each capability is given a bit and each cluster the bitmask of
+    what it offers. Lookups are memoized which means any capability combination is routed in constant time once seen.
+    """
+
+    #: Maximum number of memoized lookups.
+    limit = 1024
+
+    def __init__(self, clusters):
+
+        #
+        # - order the clusters by name length to favor the most specialized ones
+        # - turn each cluster into a bitmask
+        #
+        self.bits = {}
+        self.masks = []
+        self.memoized = {}
+        for tag in sorted(clusters, key=lambda item: (len(item), item)):
+            mask = 0
+            for token in tag.split('-'):
+                if token not in self.bits:
+                    self.bits[token] = 1 << len(self.bits)
+                mask |= self.bits[token]
+            self.masks.append((tag, mask))
+
+    def match(self, capabilities):
+        """
+        Looks for the clusters offering all the specified capabilities.
+
+        :type capabilities: str
+        :param capabilities: one or more capabilities separated by a '+'
+        :rtype: list
+        """
+
+        if capabilities in self.memoized:
+            return self.memoized[capabilities]
+
+        #
+        # - any unknown capability means we can't match anything
+        #
+        mask = 0
+        matched = []
+        tokens = capabilities.split('+')
+        if all(token in self.bits for token in tokens):
+            for token in tokens:
+                mask |= self.bits[token]
+            matched = [tag for tag, offered in self.masks if offered & mask == mask]
+
+        if len(self.memoized) < self.limit:
+            self.memoized[capabilities] = matched
+
+        return matched
+
 
 if __name__ == '__main__':
 
@@ -39,12 +177,58 @@ if __name__ == '__main__':
         #
         # - parse our ochopod hints
         # - enable CLI logging
-        # - grab redis & connect to it
+        # - grab redis & connect to it (the connection pool is shared by all our threads)
         #
         hints = json.loads(os.environ['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
-        tokens = os.environ['redis'].split(':')
-        client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0)
+        client = store.connect(os.environ['redis'], connections=64)
+
+        #
+        # - LUA script used to record a git push in one atomic round-trip
+        # - it updates the git: & slave: keys and queues the build unless it is pending already, in which case
+        #   the commit we superseded is recorded instead (the slave will report it as skipped)
+        # - running it twice with the same push is harmless (e.g if we retry after a timeout)
+        # - the pending-since sorted set records when each pending key was queued : a key pending for too long
+        #   is assumed lost (see STALE) and queued again
+        # - the build goes to the normal lane unless the repository asked for another one via its
+        #   integration.yml (the slave then stores it under priority:<key>)
+        #
+        record = client.register_script(
+            """
+            local previous = redis.call('getset', KEYS[1], ARGV[1])
+            redis.call('set', KEYS[2], ARGV[2])
+            local since = redis.call('zscore', KEYS[3], ARGV[3])
+            if not since or tonumber(since) < tonumber(ARGV[5]) - tonumber(ARGV[6]) then
+                redis.call('zadd', KEYS[3], ARGV[5], ARGV[3])
+                local lane = redis.call('get', KEYS[4])
+                local queue = KEYS[6]
+                if lane == 'high' then
+                    queue = KEYS[5]
+                elseif lane == 'low' then
+                    queue = KEYS[7]
+                end
+                redis.call('rpush', queue, ARGV[4])
+                return 1
+            end
+            if previous and previous ~= ARGV[1] then
+                redis.call('rpush', KEYS[8], cjson.decode(previous)['after'])
+            end
+            return 0
+            """)
+
+        #
+        # - same thing for manual builds (which can also force a build to be queued)
+        #
+        enqueue = client.register_script(
+            """
+            local since = redis.call('zscore', KEYS[1], ARGV[1])
+            if ARGV[5] == '0' and since and tonumber(since) >= tonumber(ARGV[3]) - tonumber(ARGV[4]) then
+                return 0
+            end
+            redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+            redis.call('rpush', KEYS[2], ARGV[2])
+            return 1
+            """)
 
         #
         # - we got a tally of how many pods we have for each slave category
@@ -52,6 +236,93 @@ if __name__ == '__main__':
         #
         slaves = json.loads(os.environ['slaves'])
 
+        #
+        # - build one consistent hash ring per slave cluster
+        # - note the tally is computed by our pod script which will restart us whenever it changes
+        #
+        rings = {cluster: Ring(size) for cluster, size in slaves.items()}
+        index = Index(slaves.keys())
+
+        def _ingest(key, cluster, qid, payload):
+
+            now = time.time()
+            build = \
+                {
+                    'key': key,
+                    'queued': now
+                }
+
+            keys = \
+                [
+                    'git:%s' % key,
+                    'slave:%s' % key,
+                    'pending-since',
+                    'priority:%s' % key
+                ] + [_queue(cluster, qid, lane) for lane in LANES] + ['skipped:%s' % key]
+
+            if record(keys=keys, args=[payload, cluster, key, json.dumps(build), now, STALE]):
+                logger.debug('requested build @ %s -> %s' % (key, cluster))
+            else:
+                logger.debug('build already pending @ %s' % key)
+
+        #
+        # - cached snapshot of how loaded each slave cluster is
+        #
+        snapshot = \
+            {
+                'load': {},
+                'since': 0.0
+            }
+
+        def _load():
+
+            #
+            # - refresh our snapshot every 5 seconds
+            # - the load is the # of pending builds plus the # of busy workers, divided by the # of slaves
+            # - the slaves flag their busy workers in the busy:<cluster> sorted set (the score being an
+            #   expiration timestamp in case they die mid-build)
+            # - keep the previous snapshot if we fail to talk to redis
+            #
+            now = time.time()
+            if now - snapshot['since'] > 5.0:
+                try:
+                    clusters = sorted(slaves.keys())
+                    pipe = client.pipeline()
+                    for cluster in clusters:
+                        pipe.zcount('busy:%s' % cluster, now, '+inf')
+                        for qid in range(slaves[cluster]):
+                            for lane in LANES:
+                                pipe.llen(_queue(cluster, qid, lane))
+
+                    counts = pipe.execute()
+                    load = {}
+                    for cluster in clusters:
+                        span = 1 + slaves[cluster] * len(LANES)
+                        load[cluster] = float(sum(counts[:span])) / slaves[cluster]
+                        counts = counts[span:]
+
+                    snapshot['load'] = load
+                    snapshot['since'] = now
+
+                except Exception as failure:
+
+                    logger.warning('unable to refresh our load snapshot (%s)' % diagnostic(failure))
+
+            return snapshot['load']
+
+        @web.errorhandler(redis.RedisError)
+        def _unavailable(failure):
+
+            #
+            # - redis is unreachable (restarting, failing over...)
+            # - ask the client to try again a bit later instead of failing with a HTTP 500
+            #
+            logger.warning('unable to reach redis (%s)' % str(failure))
+            return '', 503, \
+                {
+                    'Retry-After': '5'
+                }
+
         @web.route('/ping', methods=['GET'])
         def _ping():
 
@@ -68,17 +339,75 @@ if __name__ == '__main__':
             # - otherwise default to a text/plain response
             #
             raw = request.accept_mimetypes.best_match(['application/json']) is None
-            payload = client.get('status:%s' % key)
-            if payload is None:
+            if 'since' in request.args:
+
+                #
+                # - tail mode : return whatever the slave streamed past the specified line #
+                # - if there is nothing new and the build is still running long-poll for up to ?wait seconds
+                # - the X-Next header tells the client what to pass as ?since next time
+                #
+                since = int(request.args['since'])
+                deadline = time.time() + min(30.0, float(request.args.get('wait', 0)))
+                while 1:
+                    info = client.hgetall('stream-info:%s' % key)
+                    if not info:
+                        return '', 404
+
+                    if int(info['total']) > since or info['live'] == '0' or time.time() >= deadline:
+                        break
+
+                    time.sleep(0.5)
+
+                pipe = client.pipeline()
+                pipe.hgetall('stream-info:%s' % key)
+                pipe.lrange('stream:%s' % key, 0, -1)
+                info, lines = pipe.execute()
+                total = int(info['total'])
+                tail = lines[max(0, since - (total - len(lines))):]
+                if raw:
+                    return '\n'.join(tail), 200, \
+                        {
+                            'Content-Type': 'text/plain; charset=utf-8',
+                            'X-Live': info['live'],
+                            'X-Next': str(total)
+                        }
+
+                js = \
+                    {
+                        'live': int(info['live']),
+                        'next': total,
+                        'log': tail
+                    }
+
+                return json.dumps(js), 200, \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8'
+                    }
+
+            #
+            # - the status is a compact summary, its log is compressed and stored separately
+            # - only fetch (and decompress) the log if we need it (e.g unless ?summary is specified)
+            # - note older statuses embed their log
+            #
+            summary = not raw and 'summary' in request.args
+            pipe = client.pipeline()
+            pipe.get('status:%s' % key)
+            if not summary:
+                pipe.get('status-log:%s' % key)
+            replies = pipe.execute()
+            if replies[0] is None:
                 return '', 404
 
+            js = json.loads(replies[0])
+            if not summary and 'log' not in js:
+                js['log'] = _unpack(replies[1]) if replies[1] is not None else []
+
             if raw:
 
                 #
                 # - if 'application/json' was not requested simply dump the log as is
                 # - force the response code to be HTTP 412 upon failure and HTTP 200 otherwise
                 #
-                js = json.loads(payload)
                 code = 200 if js['ok'] else 412
                 return '\n'.join(js['log']), code, \
                     {
@@ -91,11 +420,145 @@ if __name__ == '__main__':
                 # - if 'application/json' was requested always respond with a HTTP 200
                 # - the response body then contains our serialized JSON output
                 #
-                return payload, 200, \
+                if summary:
+                    js.pop('log', None)
+
+                return json.dumps(js), 200, \
                     {
                         'Content-Type': 'application/json; charset=utf-8'
                     }
 
+        @web.route('/metrics', methods=['GET'])
+        def _metrics():
+
+            #
+            # - render whatever the slaves recorded using the prometheus text format
+            # - the metrics hash tells us what families we have and their type
+            # - histogram fields are formatted as <labels>|<upper bound>, <labels>|sum or <labels>|count
+            # - skip the per cluster aggregates recorded by older slaves (they would be counted twice)
+            #
+            def _order(field):
+                labels, suffix = field.rsplit('|', 1)
+                return (labels, 1, suffix) if suffix in ['sum', 'count'] else (labels, 0, float(suffix))
+
+            lines = []
+            families = client.hgetall('metrics')
+            pipe = client.pipeline()
+            for family in sorted(families):
+                pipe.hgetall('metrics:%s' % family)
+
+            for family, fields in zip(sorted(families), pipe.execute()):
+                kind = families[family]
+                fields = {field: value for field, value in fields.items() if 'repo="' in field}
+                lines += ['# TYPE %s %s' % (family, kind)]
+                if kind == 'counter':
+                    lines += ['%s{%s} %s' % (family, field, fields[field]) for field in sorted(fields)]
+                    continue
+
+                for field in sorted(fields, key=_order):
+                    labels, suffix = field.rsplit('|', 1)
+                    if suffix in ['sum', 'count']:
+                        lines += ['%s_%s{%s} %s' % (family, suffix, labels, fields[field])]
+                    else:
+                        lines += ['%s_bucket{%s,le="%s"} %s' % (family, labels, suffix, fields[field])]
+
+            #
+            # - add the current depth of each slave queue (per priority lane)
+            #
+            shards = [(cluster, qid) for cluster, size in sorted(slaves.items()) for qid in range(size)]
+            queues = [(cluster, qid, lane) for cluster, qid in shards for lane in LANES]
+            pipe = client.pipeline()
+            for cluster, qid, lane in queues:
+                pipe.llen(_queue(cluster, qid, lane))
+
+            lines += ['# TYPE ci_queue_depth gauge']
+            for (cluster, qid, lane), depth in zip(queues, pipe.execute()):
+                lines += ['ci_queue_depth{cluster="%s",lane="%s",queue="%d"} %d' % (cluster, lane, qid, depth)]
+
+            return '\n'.join(lines) + '\n', 200, \
+                {
+                    'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+                }
+
+        @web.route('/history/<path:path>', methods=['GET'])
+        def _history(path):
+
+            branch = 'master'
+            key = '%s:%s' % (branch, path)
+
+            #
+            # - force a json output if the Accept header matches 'application/json'
+            # - otherwise default to a text/plain response
+            #
+            raw = request.accept_mimetypes.best_match(['application/json']) is None
+            if 'build' in request.args:
+
+                #
+                # - a specific build was requested, look it up
+                # - attach its log if we still have it
+                #
+                number = int(request.args['build'])
+                pipe = client.pipeline()
+                pipe.get('build:%s:%d' % (key, number))
+                pipe.get('build-log:%s:%d' % (key, number))
+                payload, log = pipe.execute()
+                if payload is None:
+                    return '', 404
+
+                js = json.loads(payload)
+                js['log'] = _unpack(log) if log is not None else []
+                if raw:
+
+                    #
+                    # - same as /status : dump the log as is and use HTTP 412 upon failure
+                    #
+                    code = 200 if js['ok'] else 412
+                    return '\n'.join(js['log']), code, \
+                        {
+                            'Content-Type': 'text/plain; charset=utf-8'
+                        }
+
+                return json.dumps(js), 200, \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8'
+                    }
+
+            #
+            # - list the most recent builds first (use ?limit to specify how many)
+            # - skip whatever expired in the meantime
+            #
+            limit = int(request.args.get('limit', 25))
+            numbers = client.zrevrange('history:%s' % key, 0, limit - 1)
+            pipe = client.pipeline()
+            for number in numbers:
+                pipe.get('build:%s:%s' % (key, number))
+            builds = [json.loads(payload) for payload in pipe.execute() if payload is not None]
+            if not builds:
+                return '', 404
+
+            if raw:
+
+                #
+                # - one line per build with its outcome and duration
+                # - the duration of each step is appended
+                #
+                lines = []
+                for js in builds:
+                    timings = ', '.join('%s %ds' % (step['step'], step['seconds']) for step in js['steps'])
+                    outcome = 'passed' if js['ok'] else 'failed'
+                    tokens = (js['build'], outcome, js['sha'][0:10], js['seconds'], timings)
+                    lines += ['#%d [%s] %s in %d seconds (%s)' % tokens]
+
+                return '\n'.join(lines), 200, \
+                    {
+                        'Content-Type': 'text/plain; charset=utf-8'
+                    }
+
+            return json.dumps(builds), 200, \
+                {
+                    'Content-Type': 'application/json; charset=utf-8'
+                }
+
         @web.route('/', methods=['POST'], defaults={'capabilities': None})
         @web.route('/<capabilities>', methods=['POST'])
         def _git_hook(capabilities):
@@ -135,30 +598,38 @@ if __name__ == '__main__':
             if capabilities is None:
 
                 #
-                # - no specific capability requested, just pick a slave cluster at random
+                # - no specific capability requested, any slave cluster will do
+                # - shuffle them to pick one at random in case of a tie
                 #
-                cluster = choice(slaves.keys())
+                matched = slaves.keys()
+                shuffle(matched)
 
             else:
 
                 #
-                # - look at our slave dependencies
                 # - try to match the requested capabilities against what the various slaves offer
-                # - the slave clusters are named slave-[<token>]* where each token is a capability
+                # - they are ordered from the most specialized to the least specialized
                 #
-                cluster = None
-                caps = set(capabilities.split('+'))
-                for tag in sorted(slaves.keys(), key=lambda item: (len(item), item)):
-                    offered = set(tag.split('-'))
-                    logger.debug(caps)
-                    logger.debug(offered)
-                    if caps.issubset(offered):
-                        cluster = tag
-                        break
+                matched = index.match(capabilities)
+
+            #
+            # - pick the cluster with the lowest load (e.g the shortest expected wait)
+            # - in case of a tie the first one wins
+            # - stick to the cluster the repository was built on last (where its mirror & work tree are) unless it
+            #   is clearly more loaded than the best candidate
+            #
+            cfg = js['repository']
+            path = cfg['full_name']
+            key = '%s:%s' % (branch, path)
+            load = _load()
+            weigh = lambda tag: load[tag] if tag in load else 0.0
+            cluster = min(matched, key=weigh) if matched else None
+            current = client.get('slave:%s' % key) if cluster else None
+            if current in matched and weigh(current) <= weigh(cluster) + MARGIN:
+                cluster = current
 
             #
             # - if we couldn't find a match abort on a 304
-            # - otherwise use the # of slaves in that cluster as our modulo
             #
             logger.debug(cluster)
             if not cluster:
@@ -168,21 +639,15 @@ if __name__ == '__main__':
             # - hash the data from git to send it to a specific queue
             # - we do this to splay out the traffic amongst our slaves while retaining stickiness
             #
-            cfg = js['repository']
-            path = cfg['full_name']
-            modulo = slaves[cluster]
-            qid = hash(path) % modulo
-            key = '%s:%s' % (branch, path)
-            client.set('git:%s' % key, request.data)
-            client.set('slave:%s' % key, cluster)
-            logger.debug('updated git push data @ %s' % key)
+            qid = rings[cluster].pick(path)
 
-            build = \
-                {
-                    'key': key
-                }
-            client.rpush('queue-%s-%d' % (cluster, qid), json.dumps(build))
-            logger.debug('requested build @ %s -> %s' % (key, cluster))
+            #
+            # - record the push before acknowledging it (this is a single round-trip)
+            # - only queue the key if it is not pending already (the pending build will pick the push data
+            #   we just updated up)
+            # - if redis is unreachable we fail on a 503 and git will report the delivery as failed
+            #
+            store.retry(lambda: _ingest(key, cluster, qid, request.data), attempts=3)
             return '', 200
 
         @web.route('/build/<path:path>', methods=['POST'])
@@ -213,27 +678,39 @@ if __name__ == '__main__':
             if cluster not in slaves:
                 return '', 304
 
-            modulo = slaves[cluster]
-            qid = hash(path) % modulo
+            qid = rings[cluster].pick(path)
 
             #
-            # - simply push they key to the appropriate queue
+            # - simply push they key to the appropriate queue unless already pending
+            # - a reset always goes through
+            # - manual builds go to the high priority lane unless specified otherwise via X-Priority
             #
             reset = 'X-Reset' in request.headers and request.headers['X-Reset'] == 'true'
+            lane = request.headers['X-Priority'] if 'X-Priority' in request.headers else 'high'
+            if lane not in LANES:
+                return '', 400
+
+            now = time.time()
             build = \
                 {
                     'key': key,
+                    'queued': now,
                     'reset': reset
                 }
 
-            client.rpush('queue-%s-%d' % (cluster, qid), json.dumps(build))
-            logger.debug('requested build @ %s -> %s' % (key, cluster))
+            args = [key, json.dumps(build), now, STALE, int(reset)]
+            if not enqueue(keys=['pending-since', _queue(cluster, qid, lane)], args=args):
+                logger.debug('build already pending @ %s' % key)
+                return '', 200
+
+            logger.debug('requested %s priority build @ %s -> %s' % (lane, key, cluster))
             return '', 200
 
         #
         # - run our flask endpoint on TCP 5000
+        # - note we need to be threaded to support long-polling
         #
-        web.run(host='0.0.0.0', port=5000)
+        web.run(host='0.0.0.0', port=5000, threaded=True)
 
     except Exception as failure:
 
@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import redis
+import time
+
+from random import uniform
+
+#
+# - common redis access layer used by both the hook & the slaves
+# - please note this file is duplicated in both images : keep the copies in sync
+#
+logger = logging.getLogger('ochopod')
+
+#: Errors worth retrying (e.g redis is restarting, failing over or momentarily unreachable).
+TRANSIENT = (redis.ConnectionError, redis.TimeoutError, redis.BusyLoadingError)
+
+
+def connect(where, connections=16, timeout=5.0):
+    """
+    Returns a redis client backed by a bounded connection pool. Callers block for up to <timeout> seconds when all
+    the connections are in use instead of failing right away. Sockets are kept alive and time out after <timeout>
+    seconds. Idle connections are checked before being re-used. Please note a command that timed out is never sent
+    again behind our back (it may have gone through) : use retry() for the calls that are safe to repeat.
+
+    :type where: str
+    :type connections: int
+    :type timeout: float
+    :param where: the redis endpoint formatted as <host>:<port>
+    :param connections: the maximum number of connections to open
+    :param timeout: the socket & pool timeout in seconds
+    :rtype: :class:`redis.StrictRedis`
+    """
+
+    tokens = where.split(':')
+    pool = redis.BlockingConnectionPool(
+        host=tokens[0],
+        port=int(tokens[1]),
+        db=0,
+        max_connections=connections,
+        timeout=timeout,
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+        socket_keepalive=True,
+        health_check_interval=30)
+
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def retry(call, attempts=0, base=0.25, cap=30.0):
+    """
+    Invokes call() until it goes through, retrying upon transient redis errors. The delay between attempts grows
+    exponentially up to <cap> seconds and is randomized (full jitter) so that a bunch of clients losing redis at the
+    same time do not all come back at once.
+
+    :type call: callable
+    :type attempts: int
+    :type base: float
+    :type cap: float
+    :param call: the callable to invoke (it must be safe to invoke again if it failed)
+    :param attempts: the maximum number of attempts (0 means retry forever)
+    :param base: the initial delay in seconds
+    :param cap: the maximum delay in seconds
+    :return: whatever call() returned
+    """
+
+    attempt = 0
+    while 1:
+        try:
+            return call()
+        except TRANSIENT as failure:
+            attempt += 1
+            if attempts and attempt >= attempts:
+                raise
+
+            delay = uniform(0, min(cap, base * 2 ** attempt))
+            logger.warning('redis unavailable (%s), retrying in %.1f seconds' % (str(failure), delay))
+            time.sleep(delay)
@@ -11,9 +11,13 @@
 #  disclosure agreement, expressly prescribing the scope and manner of
 #  such use.
 #
+import json
 import logging
+import os
+import redis
 import time
 
+from jinja2 import Environment, FileSystemLoader
 from ochopod.bindings.generic.marathon import Pod
 from ochopod.models.piped import Actor as Piped
 
@@ -44,11 +48,55 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
+            js = {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
 
-            return {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
+            #
+            # - add a few vitals from INFO (memory, evictions, persistence)
+            # - add the worst latency events recorded by the latency monitor
+            # - make sure a redis issue does not fail our sanity check
+            #
+            try:
+                client = redis.StrictRedis(host='localhost', port=6379, db=0, socket_timeout=5.0)
+                info = client.info()
+                js['memory'] = '%s used, %s peak' % (info['used_memory_human'], info['used_memory_peak_human'])
+                js['evicted'] = '%d keys' % info['evicted_keys']
+                js['ops'] = '%d per second' % info['instantaneous_ops_per_sec']
+                js['persistence'] = 'aof %s, rdb %s' % \
+                    (info.get('aof_last_bgrewrite_status', 'n/a'), info['rdb_last_bgsave_status'])
+
+                events = client.execute_command('LATENCY', 'LATEST')
+                worst = sorted(events, key=lambda event: -int(event[3]))[:3]
+                js['latency'] = ', '.join('%s %s ms (max %s ms)' % (name, latest, peak)
+                                          for name, _, latest, peak in worst) or 'n/a'
+
+            except Exception as failure:
+
+                logger.warning('unable to query redis (%s)' % failure)
+
+            return js
 
         def configure(self, _):
 
+            #
+            # - render our redis configuration from the pod settings
+            # - the append-only file protects the queues while RDB snapshots are kept rare
+            # - the memory cap only evicts keys with an expiration (e.g the build logs)
+            #
+            settings = json.loads(os.environ['pod']) if 'pod' in os.environ else {}
+            save = settings['save'] if 'save' in settings and settings['save'] else []
+            env = Environment(loader=FileSystemLoader('/opt/redis-2.8.17/pod/templates'))
+            template = env.get_template('redis-server.conf')
+            mappings = \
+                {
+                    'appendonly': 'no' if 'appendonly' in settings and not settings['appendonly'] else 'yes',
+                    'snapshots': '\n'.join('save %s' % rule for rule in save) or 'save ""',
+                    'maxmemory': int(settings['maxmemory']) if 'maxmemory' in settings else 768,
+                    'latency': int(settings['latency']) if 'latency' in settings else 100
+                }
+
+            with open('/opt/redis-2.8.17/redis-server.conf', 'w') as f:
+                f.write(template.render(mappings))
+
             return '/usr/local/bin/redis-server redis-server.conf', {}
 
     Pod().boot(Strategy)
\ No newline at end of file
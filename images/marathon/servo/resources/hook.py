@@ -14,26 +14,362 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import base64
+import fcntl
 import hashlib
 import hmac
 import json
 import logging
 import ochopod
 import os
+import re
 import string
+import tarfile
 import tempfile
 import time
+import uuid
 import shutil
 import sys
 
-from flask import Flask, request
+from flask import Flask, Request, Response, request
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import shell
 from os import path
+from Queue import Queue, Empty, Full
+from subprocess import Popen, PIPE, STDOUT
+from threading import Condition, Thread
 
 logger = logging.getLogger('ochopod')
 
+#
+# - use the cryptography package to decrypt the .aes files if it is available
+# - otherwise we'll fallback on running openssl
+#
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+class Unpacker():
+    """
+    Sink the uploaded archive is written into as it is received. Each chunk is added to the HMAC and handed over
+    (via a bounded queue) to a thread extracting the archive on the fly, which means the upload is never stored as is
+    nor read twice. The archive size, its unpacked size and its number of entries are capped. Only regular files and
+    directories are extracted and their paths must stay within the target directory. Any problem is reported by
+    finish(). Either finish() or abort() must be invoked once the upload is over.
+    """
+
+    #: Size of the chunks read from the request when the archive is posted as the raw body.
+    chunk = 65536
+
+    def __init__(self, key, where, limits):
+
+        self.digest = hmac.new(key, '', hashlib.sha1)
+        self.where = where
+        self.limits = limits
+        self.size = 0
+        self.failure = None
+        self.used = 0
+        self.queue = Queue(maxsize=64)
+        self.buffer = ''
+        self.thread = Thread(target=self._extract)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, chunk):
+
+        #
+        # - the HMAC is always computed over the whole upload
+        # - stop feeding the extraction as soon as something went wrong
+        #
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        if self.failure is None and self.size > self.limits['upload']:
+            self.failure = 'the archive is larger than %d MB' % (self.limits['upload'] >> 20)
+
+        if self.failure is None:
+            self.queue.put(chunk)
+
+    def seek(self, *_):
+
+        #
+        # - werkzeug rewinds the file once written, nothing to do
+        #
+        pass
+
+    def read(self, size=-1):
+
+        #
+        # - invoked by tarfile from our extraction thread
+        # - None marks the end of the upload
+        #
+        while self.buffer is not None and (size < 0 or len(self.buffer) < size):
+            chunk = self.queue.get()
+            if chunk is None:
+                data, self.buffer = self.buffer, None
+                return data
+            self.buffer += chunk
+
+        if self.buffer is None:
+            return ''
+
+        size = len(self.buffer) if size < 0 else size
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def consume(self, stream):
+
+        #
+        # - used when the archive is posted as the raw request body
+        #
+        self.used = 1
+        for chunk in iter(lambda: stream.read(self.chunk), ''):
+            self.write(chunk)
+
+    def finish(self):
+
+        #
+        # - signal the end of the upload and wait for the extraction to be done
+        # - return the HMAC formatted like the X-Signature header
+        #
+        self.queue.put(None)
+        self.thread.join()
+        assert self.used, 'no archive uploaded'
+        assert self.failure is None, self.failure
+        return 'sha1=' + self.digest.hexdigest()
+
+    def abort(self):
+
+        #
+        # - the upload did not go through (e.g the client went away) : stop the extraction
+        #
+        self.failure = self.failure or 'upload interrupted'
+        self.queue.put(None)
+        self.thread.join()
+
+    def _extract(self):
+
+        try:
+
+            #
+            # - if we have no target directory we just compute the HMAC (e.g the bundle is cached already)
+            #
+            if self.where is None:
+                return
+
+            entries = 0
+            unpacked = 0
+            root = path.realpath(self.where)
+            archive = tarfile.open(fileobj=self, mode='r|gz')
+            for member in archive:
+
+                entries += 1
+                unpacked += member.size
+                assert entries <= self.limits['entries'], \
+                    'the archive has more than %d entries' % self.limits['entries']
+                assert unpacked <= self.limits['unpacked'], \
+                    'the archive unpacks to more than %d MB' % (self.limits['unpacked'] >> 20)
+
+                assert member.isfile() or member.isdir(), '%s is not a regular file or directory' % member.name
+                target = path.realpath(path.join(root, member.name))
+                assert target == root or target.startswith(root + os.sep), '%s is outside the archive' % member.name
+                archive.extract(member, root)
+
+        except AssertionError as failure:
+
+            self.failure = self.failure or str(failure)
+
+        except Exception as failure:
+
+            self.failure = self.failure or 'unable to open the archive (%s)' % failure
+
+        finally:
+
+            #
+            # - note write() may have reported a failure first (e.g the upload is too large)
+            # - keep draining the queue until the end of the upload so that write() never blocks
+            #
+            while self.buffer is not None:
+                self.read(self.chunk)
+
+
+class Streamed(Request):
+    """
+    Request whose multipart file upload (if any) is streamed into an :class:`Unpacker` set by the view before the
+    form is parsed. Please note werkzeug does not tell us which field a file belongs to : the first file is streamed
+    and the view must then check it was the expected field.
+    """
+
+    unpacker = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+
+        if self.unpacker is not None and not self.unpacker.used:
+            self.unpacker.used = 1
+            return self.unpacker
+
+        return Request._get_file_stream(self, total_content_length, content_type, filename, content_length)
+
+
+class Job():
+    """
+    Scripts run asynchronously on behalf of a client : their state (queued, running or done), their outcome and the
+    output they produced so far. Readers can wait for new output. This class is thread-safe.
+    """
+
+    def __init__(self, scripts):
+
+        self.id = uuid.uuid4().hex
+        self.scripts = scripts
+        self.state = 'queued'
+        self.ok = 0
+        self.log = []
+        self.finished = 0.0
+        self.condition = Condition()
+
+    def emit(self, line):
+
+        with self.condition:
+            self.log.append(line)
+            self.condition.notify_all()
+
+    def update(self, state, ok=0):
+
+        with self.condition:
+            self.state = state
+            self.ok = ok
+            if state == 'done':
+                self.finished = time.time()
+            self.condition.notify_all()
+
+    def tail(self, since, wait):
+
+        #
+        # - return whatever was produced past line #<since>, waiting up to <wait> seconds for something new
+        #
+        deadline = time.time() + wait
+        with self.condition:
+            while len(self.log) <= since and self.state != 'done' and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+
+            return self.state, self.ok, self.log[since:], len(self.log)
+
+
+def _run(snippet, cwd, env, emit):
+    """
+    Runs a shell snippet and forwards each line it outputs to emit() as soon as it is produced.
+
+    :type snippet: str
+    :type cwd: str
+    :type env: dict
+    :type emit: callable
+    :param snippet: the shell snippet to run
+    :param cwd: the working directory
+    :param env: the environment variables to pass down
+    :param emit: callable invoked with each output line
+    :rtype: int
+    """
+
+    pid = Popen(snippet, shell=True, stdout=PIPE, stderr=STDOUT, cwd=cwd, env=env)
+    for line in iter(pid.stdout.readline, ''):
+        emit(line.rstrip('\n'))
+
+    return pid.wait()
+
+
+def _decrypt(where, password):
+    """
+    Decrypts a file produced by *openssl enc -base64 -aes-256-cbc -k <password>* and writes the result next to it
+    (minus its .aes extension). The key and IV are derived from the password and salt the same way openssl does
+    (EVP_BytesToKey using MD5). This is done in-process when the cryptography package is available, by running
+    openssl otherwise.
+
+    :type where: str
+    :type password: str
+    :param where: the absolute path of the encrypted file
+    :param password: the password the file was encrypted with
+    :rtype: bool
+    """
+
+    bare, _ = path.splitext(where)
+    if Cipher is None:
+        code, _ = shell('openssl enc -d -base64 -aes-256-cbc -k %s -in %s -out %s' % (password, where, bare))
+        return code == 0
+
+    try:
+
+        #
+        # - the payload is base64 encoded and starts with 'Salted__' followed by an 8 bytes salt
+        #
+        with open(where, 'rb') as f:
+            raw = base64.b64decode(f.read())
+
+        if len(raw) < 32 or raw[:8] != 'Salted__':
+            return False
+
+        salt = raw[8:16]
+        derived = ''
+        block = ''
+        while len(derived) < 48:
+            block = hashlib.md5(block + password + salt).digest()
+            derived += block
+
+        decryptor = Cipher(algorithms.AES(derived[:32]), modes.CBC(derived[32:]), backend=default_backend()).decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        plain = unpadder.update(decryptor.update(raw[16:]) + decryptor.finalize()) + unpadder.finalize()
+
+    except (TypeError, ValueError):
+
+        #
+        # - invalid base64 content, truncated payload or bad padding (e.g wrong password)
+        #
+        return False
+
+    with open(bare, 'wb') as f:
+        f.write(plain)
+
+    return True
+
+
+def _evict(root, budget):
+    """
+    Removes the least recently used bundles from the cache until it fits within its budget. Bundles currently being
+    copied are skipped.
+
+    :type root: str
+    :type budget: int
+    :param root: the directory holding the cached bundles
+    :param budget: the maximum cache size in MB
+    """
+
+    sizes = {}
+    for item in [item for item in os.listdir(root) if not item.startswith('.') and not item.endswith('.lock')]:
+        _, lines = shell('du -sm %s' % item, cwd=root)
+        sizes[item] = int(lines[0].split()[0]) if lines else 0
+
+    total = sum(sizes.values())
+    for item in sorted(sizes.keys(), key=lambda item: path.getmtime(path.join(root, item))):
+        if total <= budget:
+            break
+
+        with open(path.join(root, '%s.lock' % item), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+
+            shutil.rmtree(path.join(root, item), ignore_errors=True)
+            logger.info('evicted bundle %s (%d MB)' % (item[0:10], sizes[item]))
+            total -= sizes[item]
+
+
 web = Flask(__name__)
+web.request_class = Streamed
 
 
 if __name__ == '__main__':
@@ -49,6 +385,49 @@ if __name__ == '__main__':
         hints = json.loads(env['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
 
+        #
+        # - parse our $pod settings (defined in the pod yml)
+        # - the upload limits are specified in MB
+        #
+        settings = json.loads(env['pod']) if 'pod' in env else {}
+        caps = settings['limits'] if 'limits' in settings and settings['limits'] else {}
+        limits = \
+            {
+                'upload': int(caps['upload'] if 'upload' in caps else 1024) << 20,
+                'unpacked': int(caps['unpacked'] if 'unpacked' in caps else 4096) << 20,
+                'entries': int(caps['entries']) if 'entries' in caps else 10000
+            }
+
+        #
+        # - the extracted (and decrypted) bundles are cached by signature under /var/cache/servo
+        # - the cache size is capped by a budget in MB
+        # - the runs work from a copy of their bundle located on the same filesystem (as a hidden directory)
+        # - the copy can optionally be made of hard links (the scripts must then never modify a file in place)
+        # - the .aes files are decrypted using up to one thread per core
+        #
+        bundles = '/var/cache/servo'
+        budget = int(settings['cache']) if 'cache' in settings else 4096
+        links = 'hardlinks' in settings and settings['hardlinks'] in [True, 'true']
+        threads = cpu_count()
+        if not path.exists(bundles):
+            os.makedirs(bundles)
+
+        #
+        # - wipe out whatever a previous incarnation of ourselves left behind (staging & run directories)
+        #
+        for item in [item for item in os.listdir(bundles) if item.startswith('.')]:
+            shutil.rmtree(path.join(bundles, item), ignore_errors=True)
+
+        #
+        # - asynchronous jobs are run by a fixed number of workers and queued when they are all busy
+        # - finished jobs are kept around for a while (in seconds) so that clients can get their outcome
+        #
+        spec = settings['jobs'] if 'jobs' in settings and settings['jobs'] else {}
+        workers = int(spec['workers']) if 'workers' in spec else 2
+        retention = int(spec['retention']) if 'retention' in spec else 3600
+        pending = Queue(maxsize=int(spec['backlog']) if 'backlog' in spec else 16)
+        jobs = {}
+
         @web.route('/callback/<token>', methods=['POST'])
         @web.route('/callback/<token>/<tag>', methods=['POST'])
         def _set_callback(token, tag='callback.raw'):
@@ -66,96 +445,336 @@ if __name__ == '__main__':
 
             return '', 200
 
-        @web.route('/run/<scripts>', methods=['POST'])
-        def _from_curl(scripts):
+        def _prepare(log):
 
             #
-            # - retrieve the X-Signature header
-            # - fast-fail on a HTTP 403 if not there or if there is a mismatch
+            # - create a temporary directory to run from
+            # - any request header in the form X-Var-* will be kept around and passed as
+            #   an environment variable when executing the script
+            # - make sure the variable is spelled in uppercase
             #
-            if not 'X-Signature' in request.headers:
-                return '', 403
+            alphabet = string.letters + string.digits
+            token = ''.join(alphabet[ord(c) % len(alphabet)] for c in os.urandom(8))
+            tmp = tempfile.mkdtemp(dir=bundles, prefix='.run-')
+            local = {key[6:].upper(): value for key, value in request.headers.items() if key.startswith('X-Var-')}
 
             #
-            # - split the last URI token in case multiple scripts are specified
+            # - craft a unique callback URL that points to this pod
+            # - this will be passed down to the script to enable transient testing jobs
             #
+            cwd = path.join(tmp, 'uploaded')
+            local['CALLBACK'] = 'http://%s/callback/%s' % (env['local'], token)
+            blocked[token] = cwd
+            context = \
+                {
+                    'cwd': cwd,
+                    'env': local,
+                    'tmp': tmp,
+                    'token': token
+                }
+
+            for key, value in local.items():
+                log += ['$%s = %s' % (key, value)]
 
-            #
-            # - force a json output if the Accept header matches 'application/json'
-            # - otherwise default to a text/plain response
-            # - create a temporary directory to run from
-            #
-            ok = 0
-            log = []
-            alphabet = string.letters + string.digits
-            token = ''.join(alphabet[ord(c) % len(alphabet)] for c in os.urandom(8))
-            raw = request.accept_mimetypes.best_match(['application/json']) is None
-            tmp = tempfile.mkdtemp()
             try:
 
                 #
-                # - any request header in the form X-Var-* will be kept around and passed as
-                #   an environment variable when executing the script
-                # - make sure the variable is spelled in uppercase
+                # - the signature is a HMAC of the archive content : use it to look the bundle up in our cache
+                # - return None upon mismatch
                 #
-                local = {key[6:].upper(): value for key, value in request.headers.items() if key.startswith('X-Var-')}
+                signature = request.headers['X-Signature']
+                matched = re.match(r'^sha1=([0-9a-f]{40})$', signature)
+                if not matched:
+                    _cleanup(context)
+                    return None
 
                 #
-                # - craft a unique callback URL that points to this pod
-                # - this will be passed down to the script to enable transient testing jobs
+                # - hold a shared lock on the bundle to prevent it from being evicted until it is copied
+                # - if the bundle is cached take it right away, before hashing the upload, and check again once
+                #   we hold it (it may have been evicted in the meantime)
+                # - otherwise only take it once the bundle is in the cache (no lock file for bogus signatures)
                 #
-                cwd = path.join(tmp, 'uploaded')
-                local['CALLBACK'] = 'http://%s/callback/%s' % (env['local'], token)
-                blocked[token] = cwd
-                for key, value in local.items():
-                    log += ['$%s = %s' % (key, value)]
+                cached = path.join(bundles, matched.group(1))
+                hold = open('%s.lock' % cached, 'a') if path.exists(cached) else None
+                try:
+
+                    if hold:
+                        fcntl.flock(hold, fcntl.LOCK_SH)
+
+                    hit = path.exists(cached)
+                    staging = None if hit else tempfile.mkdtemp(dir=bundles, prefix='.')
+                    try:
+
+                        #
+                        # - stream the archive (either the tgz multipart field or the raw request body) and extract it
+                        #   into a staging folder while computing the HMAC (use our pod token as the key)
+                        # - if the bundle is cached already only compute the HMAC
+                        # - bail out upon mismatch (nothing has run yet and the folder is wiped out)
+                        # - the archive must be the first file part (tgz field)
+                        # - stop the extraction if anything goes wrong while receiving it
+                        #
+                        unpacker = Unpacker(env['token'], staging, limits)
+                        request.unpacker = unpacker
+                        try:
+                            if request.mimetype == 'multipart/form-data':
+                                uploaded = request.files.get('tgz')
+                                assert uploaded is not None and uploaded.stream is unpacker, \
+                                    'the archive must be uploaded as the first file (tgz field)'
+                            else:
+                                unpacker.consume(request.stream)
+
+                        except Exception:
+
+                            unpacker.abort()
+                            raise
+
+                        digest = unpacker.finish()
+                        if digest != signature:
+                            _cleanup(context)
+                            return None
+
+                        if hit:
+                            log += ['bundle %s found in cache' % matched.group(1)[0:10]]
+
+                        else:
+
+                            #
+                            # - decrypt any file whose extension is .aes, wherever it is in the bundle
+                            # - spread the work over a few threads
+                            #
+                            encrypted = [path.join(root, file) for root, _, files in os.walk(staging)
+                                         for file in files if file.endswith('.aes')]
+
+                            if encrypted:
+                                pool = ThreadPool(min(len(encrypted), threads))
+                                try:
+                                    decrypted = pool.map(lambda where: _decrypt(where, env['token']), encrypted)
+                                finally:
+                                    pool.close()
+
+                                for where, ok in zip(encrypted, decrypted):
+                                    relative = path.relpath(where, staging)
+                                    log += ['decrypted %s' % relative if ok else 'unable to decrypt %s' % relative]
+
+                            #
+                            # - the bundle is complete, add it to the cache
+                            # - if someone beat us to it just use theirs (the content is the same)
+                            #
+                            try:
+                                os.rename(staging, cached)
+                            except OSError:
+                                pass
+
+                    finally:
+
+                        if staging and path.exists(staging):
+                            shutil.rmtree(staging)
+
+                    #
+                    # - copy the cached bundle to our working directory (the scripts are free to modify it)
+                    # - this is a copy-on-write clone if the filesystem supports it (e.g btrfs or xfs) and a full
+                    #   copy otherwise (e.g ext4 or the container overlay)
+                    # - if hard links are enabled just link the files instead
+                    #
+                    if not hold:
+                        hold = open('%s.lock' % cached, 'a')
+                        fcntl.flock(hold, fcntl.LOCK_SH)
+
+                    assert path.exists(cached), 'bundle %s evicted (please retry)' % matched.group(1)[0:10]
+                    os.utime(cached, None)
+                    code, _ = shell('cp -a %s %s %s' % ('-l' if links else '--reflink=auto', cached, cwd))
+                    assert code == 0, 'unable to copy the bundle'
+
+                finally:
+
+                    if hold:
+                        hold.close()
+
+                _evict(bundles, budget)
+                return context
+
+            except Exception:
+
+                _cleanup(context)
+                raise
+
+        def _execute(scripts, context, emit):
 
-                #
-                # - download the archive
-                # - compute the HMAC and compare (use our pod token as the key)
-                # - fail on a 403 if mismatch
-                #
-                where = path.join(tmp, 'bundle.tgz')
-                request.files['tgz'].save(where)
-                with open(where, 'rb') as f:
-                    bytes = f.read()
-                    digest = 'sha1=' + hmac.new(env['token'], bytes, hashlib.sha1).hexdigest()
-                    if digest != request.headers['X-Signature']:
-                        return '', 403
+            #
+            # - run each script in order
+            # - abort immediately if the script exit code is not zero
+            # - each output line is passed to emit() as soon as it is produced
+            #
+            for script in scripts.split('+'):
+                now = time.time()
+                assert path.exists(path.join(context['cwd'], script)), 'unable to find %s (check your scripts)' % script
+                code = _run('python %s 2>&1' % script, context['cwd'], context['env'], emit)
+                emit('%s ran in %d seconds' % (script, int(time.time() - now)))
+                assert code == 0, '%s failed on exit code %d' % (script, code)
 
-                #
-                # - extract it into its own folder
-                # - make sure the requested script is there
-                #
-                code, _ = shell('mkdir uploaded && tar zxf bundle.tgz -C uploaded', cwd=tmp)
-                assert code == 0, 'unable to open the archive (bogus payload ?)'
+        def _cleanup(context):
 
-                #
-                # - decrypt any file whose extension is .aes
-                # - just run openssl directly and dump the output in the working directory
-                # - note: at this point we just look for .aes file in the top level directory
-                #
-                for file in os.listdir(cwd):
-                    bare, ext = path.splitext(file)
-                    if ext != '.aes':
-                        continue
+            #
+            # - make sure to cleanup our temporary directory
+            #
+            del blocked[context['token']]
+            shutil.rmtree(context['tmp'])
+
+        def _work():
+
+            while 1:
+                job, context = pending.get()
+                ok = 0
+                job.update('running')
+                try:
+
+                    _execute(job.scripts, context, job.emit)
+                    ok = 1
+
+                except AssertionError as failure:
+
+                    job.emit('failure (%s)' % failure)
+
+                except Exception as failure:
+
+                    job.emit('unexpected failure (%s)' % diagnostic(failure))
+
+                finally:
+
+                    _cleanup(context)
+                    job.update('done', ok)
+
+        for _ in range(workers):
+            thread = Thread(target=_work)
+            thread.daemon = True
+            thread.start()
+
+        def _stream(scripts, ndjson):
+
+            #
+            # - prepare the run as usual (this reads the upload)
+            #
+            log = []
+            context = None
+            try:
+
+                context = _prepare(log)
+                if context is None:
+                    return '', 403
+
+            except AssertionError as failure:
+
+                log += ['failure (%s)' % failure]
+
+            except Exception as failure:
+
+                log += ['unexpected failure (%s)' % diagnostic(failure)]
+
+            #
+            # - run the scripts from a separate thread which pushes each output line into a bounded queue
+            # - the scripts are throttled if the client does not read fast enough
+            # - once the client is gone just discard whatever is left
+            #
+            lines = Queue(maxsize=256)
+            state = {'ok': 0, 'closed': 0}
+
+            def _emit(line):
+                if not state['closed']:
+                    lines.put(line)
+
+            def _go():
+                try:
+
+                    _execute(scripts, context, _emit)
+                    state['ok'] = 1
 
-                    code, _ = shell('openssl enc -d -base64 -aes-256-cbc -k %s -in %s -out %s' % (env['token'], file, bare), cwd=cwd)
-                    if code == 0:
-                        log += ['decrypted %s' % file]
+                except AssertionError as failure:
+
+                    _emit('failure (%s)' % failure)
+
+                except Exception as failure:
+
+                    _emit('unexpected failure (%s)' % diagnostic(failure))
+
+                finally:
+
+                    _cleanup(context)
+                    _emit(None)
+
+            def _format(line):
+                return json.dumps({'log': line}) + '\n' if ndjson else line + '\n'
+
+            def _generate():
+
+                for line in log:
+                    yield _format(line)
+
+                if context:
+                    for line in iter(lines.get, None):
+                        yield _format(line)
 
                 #
-                # - run each script in order
-                # - abort immediately if the script exit code is not zero
-                # - keep the script output as a json array
+                # - the last line reports the outcome
                 #
-                for script in scripts.split('+'):
-                    now = time.time()
-                    assert path.exists(path.join(cwd, script)), 'unable to find %s (check your scripts)' % script
-                    code, lines = shell('python %s 2>&1' % script, cwd=cwd, env=local)
-                    log += lines + ['%s ran in %d seconds' % (script, int(time.time() - now))]
-                    assert code == 0, '%s failed on exit code %d' % (script, code)
+                ok = context is not None and state['ok']
+                yield json.dumps({'ok': int(ok)}) + '\n' if ndjson else 'status: %s\n' % ('passed' if ok else 'failed')
+
+            def _close():
+                state['closed'] = 1
+                try:
+                    while 1:
+                        lines.get_nowait()
+                except Empty:
+                    pass
+
+            if context:
+                thread = Thread(target=_go)
+                thread.daemon = True
+                thread.start()
+
+            #
+            # - if we failed before running anything we can still use HTTP 412 like /run
+            #
+            mime = 'application/x-ndjson' if ndjson else 'text/plain'
+            code = 200 if context or ndjson else 412
+            response = Response(_generate(), status=code, mimetype=mime)
+            response.call_on_close(_close)
+            return response
+
+        @web.route('/run/<scripts>', methods=['POST'])
+        def _from_curl(scripts):
+
+            #
+            # - retrieve the X-Signature header
+            # - fast-fail on a HTTP 403 if not there or if there is a mismatch
+            #
+            if not 'X-Signature' in request.headers:
+                return '', 403
+
+            #
+            # - force a json output if the Accept header matches 'application/json'
+            # - otherwise default to a text/plain response
+            # - split the last URI token in case multiple scripts are specified
+            #
+            ok = 0
+            log = []
+            context = None
+            raw = request.accept_mimetypes.best_match(['application/json']) is None
 
+            #
+            # - stream the output as it comes if requested (either ?stream or accepting application/x-ndjson)
+            #
+            ndjson = any(mime == 'application/x-ndjson' for mime, _ in request.accept_mimetypes)
+            if ndjson or 'stream' in request.args:
+                return _stream(scripts, ndjson)
+
+            try:
+
+                context = _prepare(log)
+                if context is None:
+                    return '', 403
+
+                _execute(scripts, context, log.append)
                 ok = 1
 
             except AssertionError as failure:
@@ -168,11 +787,8 @@ if __name__ == '__main__':
 
             finally:
 
-                #
-                # - make sure to cleanup our temporary directory
-                #
-                del blocked[token]
-                shutil.rmtree(tmp)
+                if context:
+                    _cleanup(context)
 
             if raw:
 
@@ -203,6 +819,133 @@ if __name__ == '__main__':
                         'Content-Type': 'application/json; charset=utf-8'
                     }
 
+        @web.route('/job/<scripts>', methods=['POST'])
+        def _submit(scripts):
+
+            #
+            # - same as /run except the scripts are queued and run asynchronously
+            # - fast-fail on a HTTP 429 if our backlog is full already (before uploading anything)
+            #
+            if not 'X-Signature' in request.headers:
+                return '', 403
+
+            if pending.full():
+                return '', 429, \
+                    {
+                        'Retry-After': '30'
+                    }
+
+            #
+            # - forget about the jobs that finished a while ago
+            # - note concurrent requests may be purging the same jobs
+            #
+            now = time.time()
+            for key, job in jobs.items():
+                if job.state == 'done' and now - job.finished > retention:
+                    jobs.pop(key, None)
+
+            log = []
+            raw = request.accept_mimetypes.best_match(['application/json']) is None
+            try:
+
+                context = _prepare(log)
+                if context is None:
+                    return '', 403
+
+            except AssertionError as failure:
+
+                log += ['failure (%s)' % failure]
+                context = None
+
+            except Exception as failure:
+
+                log += ['unexpected failure (%s)' % diagnostic(failure)]
+                context = None
+
+            if context is None:
+
+                #
+                # - we failed to prepare the job, report it the same way /run would
+                #
+                if raw:
+                    return '\n'.join(log), 412, \
+                        {
+                            'Content-Type': 'text/plain; charset=utf-8'
+                        }
+
+                return json.dumps({'ok': 0, 'log': log}), 200, \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8'
+                    }
+
+            #
+            # - queue the job (its log starts with what we reported while preparing it)
+            # - if we got saturated in the meantime give up on a HTTP 503
+            #
+            job = Job(scripts)
+            for line in log:
+                job.emit(line)
+
+            try:
+                pending.put_nowait((job, context))
+            except Full:
+                _cleanup(context)
+                return '', 503, \
+                    {
+                        'Retry-After': '30'
+                    }
+
+            jobs[job.id] = job
+            logger.info('job %s queued (%s)' % (job.id, scripts))
+            return (job.id if raw else json.dumps({'id': job.id})), 202, \
+                {
+                    'Content-Type': 'text/plain; charset=utf-8' if raw else 'application/json; charset=utf-8',
+                    'Location': '/job/%s' % job.id
+                }
+
+        @web.route('/job/<key>', methods=['GET'])
+        def _poll(key):
+
+            job = jobs.get(key)
+            if job is None:
+                return '', 404
+
+            #
+            # - return the job output past line ?since (0 by default)
+            # - long-poll for up to ?wait seconds if there is nothing new yet
+            # - the X-Next header tells the client what to pass as ?since next time
+            #
+            since = int(request.args.get('since', 0))
+            wait = min(30.0, float(request.args.get('wait', 0)))
+            state, ok, lines, total = job.tail(since, wait)
+            raw = request.accept_mimetypes.best_match(['application/json']) is None
+            if raw:
+
+                #
+                # - HTTP 202 while the job is queued or running, then 200 or 412 depending on its outcome
+                #
+                code = 202 if state != 'done' else (200 if ok else 412)
+                return '\n'.join(lines), code, \
+                    {
+                        'Content-Type': 'text/plain; charset=utf-8',
+                        'X-State': state,
+                        'X-Next': str(total)
+                    }
+
+            js = \
+                {
+                    'id': key,
+                    'state': state,
+                    'ok': ok,
+                    'next': total,
+                    'log': lines
+                }
+
+            return json.dumps(js), 200, \
+                {
+                    'Content-Type': 'application/json; charset=utf-8'
+                }
+
         #
         # - run our flask endpoint on TCP 5000
         #
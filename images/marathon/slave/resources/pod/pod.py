@@ -17,6 +17,7 @@
 import json
 import logging
 import os
+import redis
 import time
 
 from jinja2 import Environment, FileSystemLoader
@@ -45,6 +46,8 @@ if __name__ == '__main__':
 
         pid = None
 
+        backend = None
+
         since = 0.0
 
         strict = True
@@ -61,8 +64,53 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
+            js = {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
 
-            return {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
+            #
+            # - add a summary of the build metrics recorded by our cluster
+            # - the metrics are recorded per repository : sum them up
+            # - the queue wait & build time 95th percentiles are estimated from the histogram buckets
+            # - make sure a redis issue does not fail our sanity check
+            #
+            if self.backend:
+                try:
+                    tokens = self.backend.split(':')
+                    client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0, socket_timeout=5.0)
+                    labels = 'cluster="%s"' % json.loads(os.environ['ochopod'])['cluster']
+                    pipe = client.pipeline()
+                    pipe.hgetall('metrics:ci_builds_total')
+                    pipe.hgetall('metrics:ci_queue_wait_seconds')
+                    pipe.hgetall('metrics:ci_build_seconds')
+                    totals, waits, builds = pipe.execute()
+
+                    #
+                    # - the labels are sorted by name (e.g cluster first, then outcome and repo)
+                    #
+                    def _sum(prefix):
+                        return sum(int(count) for field, count in totals.items() if field.startswith(prefix))
+
+                    def _p95(fields):
+                        buckets = {}
+                        for field, count in fields.items():
+                            tags, suffix = field.rsplit('|', 1)
+                            if tags.startswith('%s,' % labels) and suffix not in ['sum', 'count']:
+                                buckets[float(suffix)] = buckets.get(float(suffix), 0) + int(count)
+
+                        total = max(buckets.values()) if buckets else 0
+                        picked = min(bound for bound, count in buckets.items() if count >= 0.95 * total) if total else 0
+                        return '< %d seconds' % picked if total and picked != float('inf') else 'n/a'
+
+                    passed = _sum('%s,outcome="passed",' % labels)
+                    failed = _sum('%s,outcome="failed",' % labels)
+                    js['builds'] = '%d passed, %d failed' % (passed, failed)
+                    js['queue wait (p95)'] = _p95(waits)
+                    js['build time (p95)'] = _p95(builds)
+
+                except Exception as failure:
+
+                    logger.warning('unable to retrieve our metrics (%s)' % failure)
+
+            return js
 
         def can_configure(self, cluster):
 
@@ -70,6 +118,11 @@ if __name__ == '__main__':
 
         def configure(self, cluster):
 
+            #
+            # - keep track of where redis is (used to report our metrics)
+            #
+            self.backend = cluster.grep('redis', 6379)
+
             #
             # - render ~/.netrc which will set our git credentials
             #
@@ -90,11 +143,13 @@ if __name__ == '__main__':
             # - note we use supervisor to socat the unix socket used by the underlying docker daemon
             # - it is bound to TCP 9001 (e.g any curl to localhost:9001 will talk to the docker API)
             # - the index is unique amongst the slave cluster and used to shard builds on specific hosts
+            # - pass the cluster size as well (used to look at our siblings' queues)
             # - run the slave
             #
             return 'python slave.py', \
                    {
                        'index': cluster.index,
+                       'size': len(cluster.pods),
                        'redis': cluster.grep('redis', 6379)
                    }
 
@@ -14,25 +14,900 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import fcntl
+import glob
+import hashlib
 import json
 import logging
 import ochopod
 import os
-import redis
 import shutil
+import store
 import sys
 import time
 import yaml
+import zlib
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import cpu_count, Process
 from ochopod.core.utils import shell
 from ochopod.core.fsm import diagnostic
 from os import path
+from Queue import Queue
+from subprocess import Popen, PIPE, STDOUT
+from threading import Lock, Thread
 from yaml import YAMLError
 
 
 logger = logging.getLogger('ochopod')
 
 
+class Feed():
+    """
+    Streams build output lines into a capped redis list (stream:<key>) while the build is running. A companion
+    hash (stream-info:<key>) tracks the total # of lines written so far and whether the build is still live, which
+    lets the hook serve incremental tails. Lines are buffered and flushed in one pipeline every second by a
+    background thread. This class is thread-safe.
+    """
+
+    #: Maximum # of lines kept in the redis list.
+    cap = 4096
+
+    #: Time in seconds the stream is kept around once the build is over (or since its last update while live).
+    ttl = 86400
+
+    def __init__(self, client, key):
+
+        self.client = client
+        self.key = key
+        self.buffered = []
+        self.live = 1
+        self.lock = Lock()
+
+        pipe = self.client.pipeline()
+        pipe.delete('stream:%s' % key, 'stream-info:%s' % key)
+        pipe.hmset('stream-info:%s' % key, {'total': 0, 'live': 1})
+        pipe.expire('stream-info:%s' % key, self.ttl)
+        pipe.execute()
+
+        def _loop():
+            while self.live:
+                time.sleep(1.0)
+                try:
+                    self.flush()
+                except Exception as failure:
+                    logger.warning('unable to stream @ %s (%s)' % (key, diagnostic(failure)))
+
+        thread = Thread(target=_loop)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, line):
+
+        with self.lock:
+            self.buffered.append(line)
+
+    def flush(self):
+
+        #
+        # - the lines are dropped even if this fails : flushing them again could duplicate them
+        #
+        with self.lock:
+            if self.buffered:
+                lines, self.buffered = self.buffered, []
+                pipe = self.client.pipeline()
+                pipe.rpush('stream:%s' % self.key, *lines)
+                pipe.ltrim('stream:%s' % self.key, -self.cap, -1)
+                pipe.hincrby('stream-info:%s' % self.key, 'total', len(lines))
+                pipe.hsetnx('stream-info:%s' % self.key, 'live', 1)
+                pipe.expire('stream:%s' % self.key, self.ttl)
+                pipe.expire('stream-info:%s' % self.key, self.ttl)
+                pipe.execute()
+
+    def close(self):
+
+        self.live = 0
+        self.flush()
+        pipe = self.client.pipeline()
+        pipe.hset('stream-info:%s' % self.key, 'live', 0)
+        pipe.expire('stream:%s' % self.key, self.ttl)
+        pipe.expire('stream-info:%s' % self.key, self.ttl)
+        pipe.execute()
+
+
+#: Priority lanes from the highest to the lowest with the weight they get when draining them.
+LANES = [('high', 4), ('normal', 2), ('low', 1)]
+
+#: Upper bounds (in seconds) of the buckets used by our histograms.
+BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]
+
+
+def _labels(**kwargs):
+    """
+    Formats labels the prometheus way, e.g as a comma separated list of name="value" sorted by name.
+
+    :rtype: str
+    """
+
+    escape = lambda value: ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"' % (key, escape(value)) for key, value in sorted(kwargs.items()))
+
+
+def _observe(pipe, family, value, *labels):
+    """
+    Records a value into a prometheus-like histogram stored in the metrics:<family> redis hash. The hash holds one
+    field per set of labels and per bucket (formatted as <labels>|<upper bound>) plus the matching sum & count. The
+    buckets are cumulative and can be exposed as is.
+
+    :type pipe: :class:`redis.client.Pipeline`
+    :type family: str
+    :type value: float
+    :param pipe: the redis pipeline to use
+    :param family: the histogram name
+    :param value: the observed value
+    :param labels: one or more label strings as returned by _labels()
+    """
+
+    pipe.hset('metrics', family, 'histogram')
+    for tags in labels:
+        for bound in BUCKETS + ['+Inf']:
+            if bound == '+Inf' or value <= bound:
+                pipe.hincrby('metrics:%s' % family, '%s|%s' % (tags, bound), 1)
+
+        pipe.hincrbyfloat('metrics:%s' % family, '%s|sum' % tags, value)
+        pipe.hincrby('metrics:%s' % family, '%s|count' % tags, 1)
+
+
+def _count(pipe, family, *labels):
+    """
+    Increments a prometheus-like counter stored in the metrics:<family> redis hash (one field per set of labels).
+
+    :type pipe: :class:`redis.client.Pipeline`
+    :type family: str
+    :param pipe: the redis pipeline to use
+    :param family: the counter name
+    :param labels: one or more label strings as returned by _labels()
+    """
+
+    pipe.hset('metrics', family, 'counter')
+    for tags in labels:
+        pipe.hincrby('metrics:%s' % family, tags, 1)
+
+
+def _truncate(log, limit, width):
+    """
+    Caps a build log to <limit> lines, keeping its first quarter and its last three quarters (that is where failures
+    usually show up). Lines longer than <width> characters are clipped as well.
+
+    :type log: list
+    :type limit: int
+    :type width: int
+    :param log: the build log
+    :param limit: the maximum number of lines
+    :param width: the maximum line length
+    :rtype: list
+    """
+
+    clipped = [line if len(line) <= width else '%s... (%d more characters)' % (line[:width], len(line) - width)
+               for line in log]
+
+    if len(clipped) <= limit:
+        return clipped
+
+    head = limit / 4
+    tail = limit - head
+    return clipped[:head] + ['[truncated] %d lines' % (len(clipped) - limit)] + clipped[-tail:]
+
+
+def _pack(log):
+    """
+    Serializes and compresses a build log before storing it in redis.
+
+    :type log: list
+    :param log: the build log
+    :rtype: str
+    """
+
+    return zlib.compress(json.dumps(log), 6)
+
+
+def _run(snippet, cwd, env, emit):
+    """
+    Runs a shell snippet and forwards each line it outputs (stdout and stderr) to emit() as soon as it is produced.
+    Nothing is buffered.
+
+    :type snippet: str
+    :type cwd: str
+    :type env: dict
+    :type emit: callable
+    :param snippet: the shell snippet to run
+    :param cwd: the working directory
+    :param env: the environment variables to pass down
+    :param emit: callable invoked with each output line
+    :rtype: int
+    """
+
+    pid = Popen(snippet, shell=True, stdout=PIPE, stderr=STDOUT, cwd=cwd, env=env)
+    for line in iter(pid.stdout.readline, ''):
+        emit(line.rstrip('\n'))
+
+    return pid.wait()
+
+
+def _validate(blocks):
+    """
+    Checks the integration.yml blocks against what we support, before anything runs. Any problem raises an
+    AssertionError describing precisely what is wrong and where. Unknown attributes (typically typos) are ignored but
+    reported as warnings.
+
+    :type blocks: list
+    :param blocks: the blocks parsed from integration.yml
+    :rtype: list
+    """
+
+    scalar = (basestring, int, float)
+    strings = lambda value: isinstance(value, basestring) or \
+        (isinstance(value, list) and all(isinstance(item, basestring) for item in value))
+
+    checks = \
+        {
+            'step': (lambda value: isinstance(value, basestring) and value, 'a non empty string'),
+            'shell': (lambda value: isinstance(value, list) and value and
+                      all(isinstance(item, basestring) for item in value), 'a non empty list of strings'),
+            'cwd': (lambda value: isinstance(value, basestring), 'a string'),
+            'debug': (lambda value: isinstance(value, (bool, int)), 'a boolean'),
+            'env': (lambda value: isinstance(value, dict) and
+                    all(isinstance(item, scalar) for item in value.values()), 'a dict of scalars'),
+            'depends': (strings, 'a string or a list of strings'),
+            'parallel': (lambda value: isinstance(value, scalar), 'a scalar'),
+            'priority': (lambda value: value in [lane for lane, _ in LANES],
+                         'one of %s' % ', '.join([lane for lane, _ in LANES])),
+            'cache': (lambda value: isinstance(value, dict) and sorted(value.keys()) == ['key', 'paths'] and
+                      all(strings(item) for item in value.values()), 'a dict with paths and key (strings or lists)'),
+            'inputs': (strings, 'a string or a list of strings')
+        }
+
+    assert blocks, 'integration.yml does not define any step'
+    warnings = []
+    for index, blk in enumerate(blocks):
+
+        where = 'block #%d' % (index + 1)
+        assert isinstance(blk, dict), '%s must be a dict' % where
+        for key in ['step', 'shell']:
+            assert key in blk, '%s must define %s' % (where, key)
+
+        for key, value in sorted(blk.items()):
+            if key not in checks:
+                warnings += ['%s uses an unknown attribute "%s" (ignored)' % (where, key)]
+                continue
+
+            check, expected = checks[key]
+            assert check(value), '%s: %s must be %s' % (where, key, expected)
+
+    return warnings
+
+
+def _compile(repo, sha, plans, capacity=64):
+    """
+    Loads, validates and plans the integration.yml of a given commit. The result (the blocks, their dependency graph
+    and the validation warnings) is cached in <plans> (in LRU order) using the git blob hash of the file, which means
+    we only parse it again when it actually changes. The safe libyaml loader is used if available.
+
+    :type repo: str
+    :type sha: str
+    :type plans: :class:`collections.OrderedDict`
+    :type capacity: int
+    :param repo: the repository work tree (checked out at <sha>)
+    :param sha: the commit hash
+    :param plans: our plan cache
+    :param capacity: the maximum number of plans to cache
+    :rtype: tuple
+    """
+
+    code, lines = shell('git rev-parse -q --verify %s:integration.yml' % sha, cwd=repo)
+    if code != 0 or not lines:
+        raise IOError('integration.yml not found')
+
+    blob = lines[0].strip()
+    if blob in plans:
+        plans[blob] = plans.pop(blob)
+        return plans[blob]
+
+    with open(path.join(repo, 'integration.yml'), 'r') as f:
+        yml = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    #
+    # - the yaml can either be an array or a dict
+    # - force it to an array for convenience
+    # - turn it into a dependency graph (by default each block waits for the previous one)
+    #
+    blocks = yml if isinstance(yml, list) else [yml]
+    warnings = _validate(blocks)
+    plans[blob] = blocks, _plan(blocks), warnings
+    while len(plans) > capacity:
+        plans.popitem(last=False)
+
+    return plans[blob]
+
+
+def _plan(blocks):
+    """
+    Turns the integration.yml blocks into a dependency graph, e.g one set of block indices per block. By default
+    each block waits for the one declared before it. A block can override this by listing the steps it waits for
+    using 'depends'. Consecutive blocks sharing the same 'parallel' tag form a group : they all wait for whatever
+    the first block of the group waits for and the block following the group waits for all of them. Several blocks
+    can share the same step name as long as no block depends on it.
+
+    :type blocks: list
+    :param blocks: the blocks parsed from integration.yml (see _validate())
+    :rtype: list
+    """
+
+    graph = []
+    steps = {}
+    twice = set()
+    stage = set()
+    group = set()
+    head = None
+    for index, blk in enumerate(blocks):
+
+        #
+        # - resolve the explicit dependencies if any
+        # - we only allow to depend on steps declared before (which also guarantees we can't have cycles)
+        #
+        deps = set()
+        if 'depends' in blk:
+            names = blk['depends'] if isinstance(blk['depends'], list) else [blk['depends']]
+            for name in names:
+                assert name in steps, 'step "%s" depends on "%s" which is not declared before it' % (blk['step'], name)
+                assert name not in twice, 'step "%s" depends on "%s" which is declared twice' % (blk['step'], name)
+                deps.add(steps[name])
+
+        tag = blk['parallel'] if 'parallel' in blk else None
+        if head is not None and tag == blocks[head]['parallel']:
+
+            #
+            # - we are joining the current parallel group
+            # - wait on whatever the group's first block waits on
+            #
+            deps |= graph[head]
+            group.add(index)
+
+        else:
+
+            #
+            # - if we just closed a parallel group the implicit dependency is on all its blocks
+            # - start a new group if we have a tag
+            #
+            if head is not None:
+                stage = group
+                head = None
+
+            if 'depends' not in blk:
+                deps = set(stage)
+
+            if tag is not None:
+                head = index
+                group = {index}
+
+        if head is None:
+            stage = {index}
+
+        graph.append(deps)
+        if blk['step'] in steps:
+            twice.add(blk['step'])
+        steps[blk['step']] = index
+
+    return graph
+
+
+def _schedule(graph, run, threads):
+    """
+    Invokes run() for each node of the dependency graph once all its dependencies are done, using up to <threads>
+    concurrent threads. Any exception raised by run() will stop the scheduling and will be re-raised once the
+    threads that are still running are done.
+
+    :type graph: list
+    :type run: callable
+    :type threads: int
+    :param graph: the dependency graph as returned by _plan()
+    :param run: callable taking the node index
+    :param threads: the maximum number of nodes to run concurrently
+    """
+
+    done = set()
+    pending = range(len(graph))
+    running = 0
+    failures = []
+    events = Queue()
+
+    def _go(index):
+        try:
+            run(index)
+            events.put((index, None))
+        except Exception as failure:
+            events.put((index, failure))
+
+    while running or (pending and not failures):
+
+        #
+        # - start whatever is ready to go as long as we have threads available
+        # - note the graph from _plan() only points backwards so we can't stall
+        #
+        if not failures:
+            ready = [index for index in pending if graph[index] <= done]
+            for index in ready[:max(0, threads - running)]:
+                pending.remove(index)
+                running += 1
+                thread = Thread(target=_go, args=(index,))
+                thread.daemon = True
+                thread.start()
+
+        index, failure = events.get()
+        running -= 1
+        done.add(index)
+        if failure is not None:
+            failures.append(failure)
+
+    if failures:
+        raise failures[0]
+
+
+@contextmanager
+def _locked(where, mode=fcntl.LOCK_EX):
+    """
+    Holds a flock() on the specified lock file for the duration of the context. The lock is honored by any process
+    on the host, including other slaves sharing the same cache volume.
+
+    :type where: str
+    :type mode: int
+    :param where: the lock file (created if missing)
+    :param mode: either fcntl.LOCK_EX or fcntl.LOCK_SH
+    """
+
+    with open(where, 'a') as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _fetch(mirror, url, sha):
+    """
+    Makes sure the specified commit is available in a bare mirror, creating it first if needed. Only that commit
+    (and whatever ancestors we are missing) is fetched. The mirror master branch is then pinned on it to keep it
+    reachable. Its size is measured again whenever it grew and kept next to it for _evict() to use.
+
+    :type mirror: str
+    :type url: str
+    :type sha: str
+    :param mirror: the bare mirror directory
+    :param url: the git repository url
+    :param sha: the commit hash
+    """
+
+    with _locked('%s.fetch' % mirror):
+
+        if not path.exists(mirror):
+
+            #
+            # - the repo is not in our cache
+            # - create an empty bare mirror and turn off the automatic gc (the work trees borrow its objects)
+            #
+            code, _ = shell('git init -q --bare %s && git --git-dir=%s config gc.auto 0' % (mirror, mirror))
+            assert code == 0, 'unable to create %s' % mirror
+
+        grew = not path.exists('%s.size' % mirror)
+        code, _ = shell('git cat-file -e %s^{commit}' % sha, cwd=mirror)
+        if code != 0:
+
+            #
+            # - fetch the commit by its hash
+            # - some git servers won't allow this, in which case fall back on fetching master
+            #
+            logger.info('fetching %s @ %s' % (url, sha[0:10]))
+            code, _ = shell('git fetch -q %s %s' % (url, sha), cwd=mirror)
+            if code != 0:
+                code, _ = shell('git fetch -q %s +refs/heads/master:refs/heads/master' % url, cwd=mirror)
+            assert code == 0, 'unable to fetch %s (wrong credentials and/or git issue ?)' % sha[0:10]
+            grew = True
+
+        shell('git update-ref refs/heads/master %s' % sha, cwd=mirror)
+        os.utime(mirror, None)
+
+        #
+        # - only walk this mirror and only when it changed, the other ones are never touched
+        # - the size is written atomically as it is read without any lock
+        #
+        if grew:
+            _, lines = shell('du -sm %s' % mirror)
+            with open('%s.size.tmp' % mirror, 'w') as f:
+                f.write(lines[0].split()[0] if lines else '0')
+            os.rename('%s.size.tmp' % mirror, '%s.size' % mirror)
+
+
+def _evict(root, budget):
+    """
+    Removes the least recently used mirrors (and the work trees depending on them) until the cache fits within
+    its budget. Mirrors currently used by a build are skipped. The sizes recorded by _fetch() are used, no mirror
+    is walked here unless its size is missing.
+
+    :type root: str
+    :type budget: int
+    :param root: the directory holding the mirrors
+    :param budget: the maximum cache size in MB
+    """
+
+    sizes = {}
+    for item in [item for item in os.listdir(root) if item.endswith('.git')]:
+        try:
+            with open(path.join(root, '%s.size' % item), 'r') as f:
+                sizes[item] = int(f.read())
+        except (IOError, ValueError):
+            _, lines = shell('du -sm %s' % item, cwd=root)
+            sizes[item] = int(lines[0].split()[0]) if lines else 0
+
+    total = sum(sizes.values())
+    for item in sorted(sizes.keys(), key=lambda item: path.getmtime(path.join(root, item))):
+        if total <= budget:
+            break
+
+        with open(path.join(root, '%s.lock' % item), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+
+            shutil.rmtree(path.join('/tmp', item[:-4]), ignore_errors=True)
+            shutil.rmtree(path.join(root, item), ignore_errors=True)
+            if path.exists(path.join(root, '%s.size' % item)):
+                os.remove(path.join(root, '%s.size' % item))
+            logger.info('evicted %s (%d MB)' % (item, sizes[item]))
+            total -= sizes[item]
+
+
+def _inputs(tag, cwd, blk):
+    """
+    Computes a SHA1 digest of whatever a block declared as its inputs, e.g the git blob hashes of the files matching
+    its glob patterns (relative to the block directory) together with the block definition itself. Two runs of the
+    same block with the same digest are expected to yield the same result.
+
+    :type tag: str
+    :type cwd: str
+    :type blk: dict
+    :param tag: the repository tag
+    :param cwd: the block directory
+    :param blk: the block
+    :rtype: str
+    """
+
+    patterns = blk['inputs'] if isinstance(blk['inputs'], list) else [blk['inputs']]
+    code, lines = shell('git ls-files -s -- %s' % ' '.join(["':(glob)%s'" % pattern for pattern in patterns]), cwd=cwd)
+    assert code == 0, 'unable to list the inputs of step "%s"' % blk['step']
+
+    digest = hashlib.sha1()
+    definition = {key: value for key, value in blk.items() if key in ['step', 'shell', 'cwd', 'env', 'inputs']}
+    digest.update('%s\n%s\n' % (tag, json.dumps(definition, sort_keys=True)))
+    for line in sorted(lines):
+        digest.update('%s\n' % line)
+
+    return digest.hexdigest()
+
+
+def _fingerprint(tag, cwd, spec):
+    """
+    Computes the content address of a block cache, e.g a SHA1 digest of the repository tag, of the cached paths and
+    of the content of the files the cache is keyed on (typically a requirements.txt or a package.json). Those files
+    can be specified using glob patterns relative to the block directory.
+
+    :type tag: str
+    :type cwd: str
+    :type spec: dict
+    :param tag: the repository tag
+    :param cwd: the block directory
+    :param spec: the block cache specification
+    :rtype: str
+    """
+
+    digest = hashlib.sha1()
+    digest.update('%s\n%s\n' % (tag, '\n'.join(sorted(spec['paths']))))
+    for pattern in sorted(spec['key']):
+        matches = sorted(glob.glob(path.join(cwd, pattern)))
+        digest.update('%s\n%d\n' % (pattern, len(matches)))
+        for match in [match for match in matches if path.isfile(match)]:
+            with open(match, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def _restore(root, digest, cwd):
+    """
+    Unpacks a block cache archive into the block directory, if we have one for this digest. The archive is touched
+    to keep track of its last use.
+
+    :type root: str
+    :type digest: str
+    :type cwd: str
+    :param root: the directory holding the cache archives
+    :param digest: the cache digest as returned by _fingerprint()
+    :param cwd: the block directory
+    :rtype: bool
+    """
+
+    archive = path.join(root, '%s.tgz' % digest)
+    if not path.exists(archive):
+        return False
+
+    code, _ = shell('tar -xzf %s' % archive, cwd=cwd)
+    if code != 0:
+        return False
+
+    os.utime(archive, None)
+    return True
+
+
+def _save(root, digest, cwd, paths):
+    """
+    Packs the specified paths (relative to the block directory) into a cache archive. The archive is written under
+    a temporary name first and then renamed, so that concurrent builds can never see a partial one. Paths that do not
+    exist are ignored.
+
+    :type root: str
+    :type digest: str
+    :type cwd: str
+    :type paths: list
+    :param root: the directory holding the cache archives
+    :param digest: the cache digest as returned by _fingerprint()
+    :param cwd: the block directory
+    :param paths: the paths to cache
+    :rtype: bool
+    """
+
+    existing = [item for item in paths if path.exists(path.join(cwd, item))]
+    if not existing:
+        return False
+
+    archive = path.join(root, '%s.tgz' % digest)
+    tmp = '%s.%d-%d' % (archive, os.getpid(), time.time() * 1000)
+    code, _ = shell('tar -czf %s %s' % (tmp, ' '.join(existing)), cwd=cwd)
+    if code != 0:
+        if path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+    os.rename(tmp, archive)
+    return True
+
+
+def _prune(root, budget):
+    """
+    Removes the least recently used cache archives until the store fits within its budget. Archives being unpacked
+    while removed remain readable until the extraction is done.
+
+    :type root: str
+    :type budget: int
+    :param root: the directory holding the cache archives
+    :param budget: the maximum store size in MB
+    """
+
+    archives = [path.join(root, item) for item in os.listdir(root) if item.endswith('.tgz')]
+    sizes = {archive: path.getsize(archive) for archive in archives}
+    total = sum(sizes.values())
+    for archive in sorted(archives, key=lambda archive: path.getmtime(archive)):
+        if total <= budget * 1024 * 1024:
+            break
+
+        try:
+            os.remove(archive)
+            logger.info('evicted %s (%d MB)' % (path.basename(archive), sizes[archive] / (1024 * 1024)))
+        except OSError:
+            pass
+        total -= sizes[archive]
+
+
+def _queue(cluster, index, lane):
+    """
+    Formats the name of the redis list backing a given priority lane for a given slave. Note the normal lane is
+    using the original queue name.
+
+    :type cluster: str
+    :type index: int
+    :type lane: str
+    :param cluster: the slave cluster
+    :param index: the slave index
+    :param lane: the priority lane
+    :rtype: str
+    """
+
+    return 'queue-%s-%d' % (cluster, index) if lane == 'normal' else 'queue-%s-%d-%s' % (cluster, index, lane)
+
+
+def _greedy(client, cluster, tag):
+    """
+    Checks whether a repository used more than twice its fair share of the cluster build time over the last hour or
+    so. The build time is tracked per repository in hourly usage:<cluster>:<hour> sorted sets.
+
+    :type client: :class:`redis.StrictRedis`
+    :type cluster: str
+    :type tag: str
+    :param client: our redis client
+    :param cluster: the slave cluster
+    :param tag: the repository tag
+    :rtype: bool
+    """
+
+    hour = int(time.time() / 3600)
+    pipe = client.pipeline()
+    for window in [hour - 1, hour]:
+        pipe.zrange('usage:%s:%d' % (cluster, window), 0, -1, withscores=True)
+
+    usage = {}
+    for pairs in pipe.execute():
+        for repo, seconds in pairs:
+            usage[repo] = usage.get(repo, 0.0) + seconds
+
+    return len(usage) > 1 and tag in usage and usage[tag] > 2.0 * sum(usage.values()) / len(usage)
+
+
+def _steal(client, siblings, threshold, cached, processing):
+    """
+    Tries to steal the oldest job from one of our sibling queues, provided it has been waiting for at least
+    <threshold> seconds. Queues whose oldest job is for a repository we already have a mirror for are tried first.
+    The job is moved atomically to our processing list via a small LUA script that checks it is still at the head of
+    its queue and that its repository is not being built already (e.g by its owner, which happens when a push comes
+    in while building). If the reply is lost the job is simply returned by our next pop.
+
+    :type client: :class:`redis.StrictRedis`
+    :type siblings: list
+    :type threshold: float
+    :type cached: callable
+    :type processing: str
+    :param client: our redis client
+    :param siblings: the sibling queues
+    :param threshold: the minimum time in seconds the job must have been waiting for
+    :param cached: callable taking the job key and returning True if we already have its repository
+    :param processing: our processing list
+    :rtype: str
+    """
+
+    pop = client.register_script(
+        """
+        local expiry = redis.call('zscore', KEYS[3], ARGV[2])
+        if expiry and tonumber(expiry) > tonumber(ARGV[3]) then
+            return false
+        end
+        if redis.call('lindex', KEYS[1], 0) == ARGV[1] then
+            local entry = cjson.encode({KEYS[1], redis.call('lpop', KEYS[1])})
+            redis.call('rpush', KEYS[2], entry)
+            return entry
+        end
+        return false
+        """)
+
+    now = time.time()
+    candidates = []
+    for queue in siblings:
+        head = client.lindex(queue, 0)
+        if head is None:
+            continue
+
+        build = json.loads(head)
+        if 'queued' not in build or now - build['queued'] < threshold:
+            continue
+
+        candidates.append((not cached(build['key']), build['queued'], queue, head))
+
+    for _, _, queue, head in sorted(candidates):
+        entry = pop(keys=[queue, processing, 'building'], args=[head, json.loads(head)['key'], now])
+        if entry:
+            logger.info('stole %s from %s' % (json.loads(head)['key'], queue))
+            return entry
+
+    return None
+
+
+def _clock(client):
+    """
+    Reads the redis server time. The heartbeats are timestamped and checked against this single clock, which is
+    immune to whatever skew there is between the slaves. Note this is a separate round-trip on purpose : redis 2.8
+    does not allow a LUA script to write anything once it called TIME.
+
+    :type client: :class:`redis.StrictRedis`
+    :param client: our redis client
+    :rtype: float
+    """
+
+    secs, usecs = client.time()
+    return secs + usecs / 1000000.0
+
+
+def _reap(client, cluster, size, index):
+    """
+    Requeues the jobs left in the processing lists of workers that stopped sending heartbeats (e.g the slave was
+    killed mid-build). Each job goes back at the head of the queue it was taken from, or onto our normal lane if
+    that queue belongs to a slave index that does not exist anymore. The check and the requeuing are done atomically
+    in LUA, so that a job can never be requeued twice. The jobs still waiting in the queues of those indices (e.g
+    after a scale-down) are moved at the head of our own queues as well, in the same lane.
+
+    :type client: :class:`redis.StrictRedis`
+    :type cluster: str
+    :type size: int
+    :type index: int
+    :param client: our redis client
+    :param cluster: our cluster
+    :param size: the number of slaves in our cluster
+    :param index: our slave index
+    :rtype: int
+    """
+
+    requeue = client.register_script(
+        """
+        local beat = redis.call('zscore', KEYS[2], ARGV[2])
+        if beat and tonumber(beat) >= tonumber(ARGV[3]) then
+            return 0
+        end
+        local valid = {}
+        for n = 4, #ARGV do
+            valid[ARGV[n]] = true
+        end
+        local total = 0
+        while true do
+            local item = redis.call('rpop', KEYS[1])
+            if not item then
+                break
+            end
+            local entry = cjson.decode(item)
+            redis.call('lpush', valid[entry[1]] and entry[1] or ARGV[1], entry[2])
+            total = total + 1
+        end
+        return total
+        """)
+
+    move = client.register_script(
+        """
+        local total = 0
+        while true do
+            local js = redis.call('rpop', KEYS[1])
+            if not js then
+                break
+            end
+            redis.call('lpush', KEYS[2], js)
+            total = total + 1
+        end
+        return total
+        """)
+
+    total = 0
+    fallback = _queue(cluster, index, 'normal')
+    queues = [_queue(cluster, n, lane) for n in range(size) for lane, _ in LANES]
+    workers = client.smembers('workers:%s' % cluster)
+    deadline = _clock(client) - 30
+    for worker in workers:
+        keys = ['processing:%s-%s' % (cluster, worker), 'heartbeats:%s' % cluster]
+        reaped = requeue(keys=keys, args=[fallback, worker, deadline] + queues)
+        if reaped:
+            logger.warning('requeued %d job(s) left by worker %s' % (reaped, worker))
+            total += reaped
+
+    #
+    # - the worker identifiers are formatted as <index>-<slot> : any index that ever ran is listed
+    #
+    for n in sorted(set(int(worker.split('-')[0]) for worker in workers)):
+        if n < size:
+            continue
+
+        for lane, _ in LANES:
+            moved = move(keys=[_queue(cluster, n, lane), _queue(cluster, index, lane)])
+            if moved:
+                logger.warning('moved %d job(s) from slave #%d (gone) to our %s lane' % (moved, n, lane))
+                total += moved
+
+    return total
+
+
 if __name__ == '__main__':
 
     try:
@@ -47,213 +922,721 @@ if __name__ == '__main__':
         hints = json.loads(os.environ['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
         settings = json.loads(os.environ['pod'])
-        tokens = os.environ['redis'].split(':')
-        client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0)
-        while 1:
+        threads = int(settings['threads']) if 'threads' in settings and settings['threads'] else cpu_count()
+        count = int(settings['workers']) if 'workers' in settings else 1
+
+        #
+        # - how many builds we keep per repository and for how long (durations are specified in days)
+        # - how many lines (and how many characters per line) we keep for each build log
+        #
+        retention = settings['history'] if 'history' in settings else {}
+        history = \
+            {
+                'depth': int(retention['depth']) if 'depth' in retention else 100,
+                'summaries': int(retention['summaries'] if 'summaries' in retention else 90) * 86400,
+                'logs': int(retention['logs'] if 'logs' in retention else 7) * 86400,
+                'lines': int(retention['lines']) if 'lines' in retention else 5000,
+                'width': int(retention['width']) if 'width' in retention else 1024
+            }
+        steal = float(settings['steal']) if 'steal' in settings and settings['steal'] else 0
+
+        #
+        # - the git mirrors are stored under /var/cache/ci (which can be mapped onto the host)
+        # - the cache size is capped by a budget in MB
+        #
+        caching = settings['cache'] if 'cache' in settings and settings['cache'] else {}
+        mirrors = '/var/cache/ci/git'
+        budget = int(caching['mirrors']) if 'mirrors' in caching else 16384
+        if not path.exists(mirrors):
+            os.makedirs(mirrors)
+
+        #
+        # - same thing for the block caches (content-addressed archives)
+        #
+        artifacts = '/var/cache/ci/artifacts'
+        allowance = int(caching['artifacts']) if 'artifacts' in caching else 8192
+        if not path.exists(artifacts):
+            os.makedirs(artifacts)
+
+        def _work(slot):
 
             #
-            # - the key passed int the queue is made of the branch & repository tag
+            # - each worker runs in its own process and uses its own redis connection pool (the build threads, the
+            #   heartbeat and the feed share it)
+            # - all the workers block on the same queue (the index is unique amongst the slave cluster and
+            #   used to shard builds on specific hosts)
+            # - any redis call is retried upon failure (with a randomized backoff) : we just stall while redis is
+            #   unreachable instead of dying
             #
-            queue = 'queue-%s-%d' % (hints['cluster'], int(os.environ['index']))
-            logger.debug('waiting on %s...' % queue)
-            _, js = client.blpop(queue)
-            build = json.loads(js)
-            try:
-                started = time.time()
-                payload = client.get('git:%s' % build['key'])
-                js = json.loads(payload)
+            client = store.connect(os.environ['redis'], connections=threads + 4)
+            index = int(os.environ['index'])
+            size = int(os.environ['size'])
+            queues = [_queue(hints['cluster'], index, lane) for lane, _ in LANES]
+            others = [n for n in range(size) if n != index]
+            siblings = [_queue(hints['cluster'], n, lane) for n in others for lane, _ in LANES]
+            cached = lambda key: path.exists(path.join(mirrors, '%s.git' % key.split(':')[1].replace('/', '-')))
+
+            #
+            # - each job we pick is moved atomically to our own processing list and only removed from it once
+            #   its build is over
+            # - we refresh our heartbeat (a timestamp in the heartbeats:<cluster> sorted set) for as long as we
+            #   run : if it gets older than 30 seconds (e.g we got killed mid-build) another worker will requeue
+            #   whatever is left in our processing list (see _reap())
+            # - the heartbeats are timestamped using the redis clock (see _clock())
+            # - note this is not an expiring key on purpose : redis may evict those when running out of memory
+            # - start by recovering what a previous incarnation of ourselves may have left behind
+            # - then send our first heartbeat before registering ourselves, so that we are never seen as a worker
+            #   without one
+            #
+            worker = '%d-%d' % (index, slot)
+            processing = 'processing:%s-%s' % (hints['cluster'], worker)
+            heartbeats = 'heartbeats:%s' % hints['cluster']
+            store.retry(lambda: client.zrem(heartbeats, worker))
+            store.retry(lambda: _reap(client, hints['cluster'], size, index))
+            store.retry(lambda: client.zadd(heartbeats, {worker: _clock(client)}))
+            store.retry(lambda: client.sadd('workers:%s' % hints['cluster'], worker))
+
+            def _beat():
+                while 1:
+                    time.sleep(10.0)
+                    try:
+                        client.zadd(heartbeats, {worker: _clock(client)})
+                    except Exception as failure:
+                        logger.warning('unable to send our heartbeat -> %s' % diagnostic(failure))
+
+            beat = Thread(target=_beat)
+            beat.daemon = True
+            beat.start()
+
+            #
+            # - cache of the parsed integration.yml files (see _compile())
+            #
+            plans = OrderedDict()
+
+            #
+            # - LUA script moving the first job found in a list of queues to our processing list
+            # - the entry we keep in there also records which queue the job came from
+            # - we only pop when idle : if our processing list is not empty a previous call went through without
+            #   us getting the reply (e.g it timed out) and we just return that job instead
+            # - the turns define in which order the lanes are drained (each lane is given as many turns as its weight)
+            #
+            pop = client.register_script(
+                """
+                local stuck = redis.call('lindex', KEYS[1], 0)
+                if stuck then
+                    return stuck
+                end
+                for n = 2, #KEYS do
+                    local js = redis.call('lpop', KEYS[n])
+                    if js then
+                        local entry = cjson.encode({KEYS[n], js})
+                        redis.call('rpush', KEYS[1], entry)
+                        return entry
+                    end
+                end
+                return false
+                """)
+
+            #
+            # - LUA script retiring the builds that fell out of the history of a repository (too many or too old)
+            # - their summary and log are removed with them (the summaries don't expire so that redis never evicts
+            #   them, only the logs do)
+            #
+            retire = client.register_script(
+                """
+                local numbers = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[2])
+                local excess = redis.call('zcard', KEYS[1]) - tonumber(ARGV[3])
+                if excess > 0 then
+                    for _, number in ipairs(redis.call('zrange', KEYS[1], 0, excess - 1)) do
+                        table.insert(numbers, number)
+                    end
+                end
+                for _, number in ipairs(numbers) do
+                    redis.call('zrem', KEYS[1], number)
+                    redis.call('del', 'build:' .. ARGV[1] .. ':' .. number, 'build-log:' .. ARGV[1] .. ':' .. number)
+                end
+                return #numbers
+                """)
+
+            #
+            # - LUA script tracking how much build time each repository used per hour
+            # - the hours are indexed in the usage-hours:<cluster> sorted set and dropped once older than 2 hours
+            #
+            account = client.register_script(
+                """
+                redis.call('zincrby', ARGV[1] .. ':' .. ARGV[2], ARGV[3], ARGV[4])
+                redis.call('zadd', KEYS[1], ARGV[2], ARGV[2])
+                for _, hour in ipairs(redis.call('zrangebyscore', KEYS[1], '-inf', tonumber(ARGV[2]) - 2)) do
+                    redis.call('del', ARGV[1] .. ':' .. hour)
+                end
+                redis.call('zremrangebyscore', KEYS[1], '-inf', tonumber(ARGV[2]) - 2)
+                """)
+
+            #
+            # - LUA script sending a job from our processing list back to the end of its queue (only once)
+            #
+            defer = client.register_script(
+                """
+                if redis.call('lrem', KEYS[1], 1, ARGV[1]) == 1 then
+                    redis.call('rpush', KEYS[2], ARGV[2])
+                end
+                """)
+
+            #
+            # - LUA script claiming a job (see _claim below)
+            # - the build number and the superseded commits are recorded under claim:<cluster>-<worker> together
+            #   with the job : calling it again for the same job returns them instead of allocating a new build
+            #
+            claim = client.register_script(
+                """
+                redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+                redis.call('zadd', KEYS[7], ARGV[2], ARGV[3])
+                redis.call('zrem', KEYS[2], ARGV[3])
+                local claimed = redis.call('get', KEYS[6])
+                if not claimed or cjson.decode(claimed)[1] ~= ARGV[4] then
+                    local skipped = redis.call('lrange', KEYS[4], 0, -1)
+                    redis.call('del', KEYS[4])
+                    claimed = cjson.encode({ARGV[4], redis.call('incr', KEYS[5]), skipped})
+                    redis.call('set', KEYS[6], claimed)
+                end
+                return {redis.call('get', KEYS[3]), claimed}
+                """)
+
+            #
+            # - LUA script publishing the status of a build unless a more recent build published its own already
+            #   (e.g the repository was built concurrently elsewhere)
+            #
+            publish = client.register_script(
+                """
+                local current = redis.call('get', KEYS[1])
+                if current then
+                    local number = cjson.decode(current)['build']
+                    if number and tonumber(number) > tonumber(ARGV[1]) then
+                        return 0
+                    end
+                end
+                redis.call('set', KEYS[1], ARGV[2])
+                redis.call('setex', KEYS[2], ARGV[4], ARGV[3])
+                return 1
+                """)
+
+            turns = sum([[lane] * weight for lane, weight in LANES], [])
+            turn = 0
+            idle = time.time()
+            reaped = 0
+            while 1:
+
+                #
+                # - the key passed int the queue is made of the branch & repository tag
+                # - start with the lane whose turn it is and then fall back on the others by priority
+                #
+                first = _queue(hints['cluster'], index, turns[turn % len(turns)])
+                turn += 1
+                stolen = False
+                keys = [processing, first] + [queue for queue in queues if queue != first]
+                entry = store.retry(lambda: pop(keys=keys))
+                if not entry:
+
+                    #
+                    # - nothing pending, look for jobs left behind by dead workers every now and then
+                    # - if work stealing is on and we have been idle long enough go look at our siblings
+                    # - otherwise poll again shortly (we can't block as there is no blocking pop over several
+                    #   lists that would also move the job atomically)
+                    #
+                    now = time.time()
+                    if now - reaped > 30:
+                        reaped = now
+                        store.retry(lambda: _reap(client, hints['cluster'], size, index))
+
+                    if steal and now - idle >= steal:
+                        entry = store.retry(lambda: _steal(client, siblings, steal, cached, processing))
+                        stolen = entry is not None
+                    if not entry:
+                        time.sleep(1.0)
+                        continue
+
+                idle = time.time()
+                queue, js = json.loads(entry)
+                build = json.loads(js)
 
                 #
-                # - extract the various core parameters from the git push json
+                # - fair-share : if the repository used way more than its share of build time lately and other
+                #   builds are waiting in the same lane, send it back to the end of the lane (once)
                 #
-                ok = 1
-                complete = 0
-                cfg = js['repository']
-                tag = cfg['full_name']
-                sha = js['after']
-                last = js['commits'][0]
-                safe = tag.replace('/', '-')
-                abridged = []
-                log = ['- commit %s (%s)' % (sha[0:10], last['message'])]
-                tmp = path.join('/tmp', safe)
+                if not stolen and 'deferred' not in build and store.retry(lambda: client.llen(queue)):
+                    if store.retry(lambda: _greedy(client, hints['cluster'], build['key'].split(':')[1])):
+                        logger.debug('deferring %s (over its fair share)' % build['key'])
+                        build['deferred'] = 1
+
+                        js = json.dumps(build)
+                        store.retry(lambda: defer(keys=[processing, queue], args=[entry, js]))
+                        continue
+
+                checkout = None
                 try:
 
-                    try:
+                    #
+                    # - lock the repository work tree before doing anything
+                    # - this guarantees two workers never build the same repository at the same time
+                    # - note the key is formatted as <branch>:<repository tag>
+                    #
+                    checkout = open(path.join('/tmp', '%s.lock' % build['key'].split(':')[1].replace('/', '-')), 'a')
+                    fcntl.flock(checkout, fcntl.LOCK_EX)
+                    started = time.time()
+
+                    def _claim():
 
                         #
-                        # - if requested wipe out the directory first
-                        # - this will force a git clone
+                        # - flag ourselves as busy (the hook uses this to estimate how loaded our cluster is)
+                        # - flag the key as being built as well (our siblings won't steal it meanwhile)
+                        # - the scores are expiration timestamps in case we die mid-build
+                        # - the key is not pending anymore, any subsequent push will queue a new build
+                        # - note we need to do this before reading the push data to not miss any update
+                        # - grab the commits that got superseded while we were pending as well
+                        # - allocate our build number
+                        # - all this is done in one atomic round-trip (which is safe to retry)
                         #
-                        if 'reset' in build and build['reset']:
-                            try:
-                                shutil.rmtree(tmp)
-                                logger.info('wiped out %s' % tmp)
-                            except IOError:
-                                pass
+                        keys = \
+                            [
+                                'busy:%s' % hints['cluster'],
+                                'pending-since',
+                                'git:%s' % build['key'],
+                                'skipped:%s' % build['key'],
+                                'build-count:%s' % build['key'],
+                                claimed,
+                                'building'
+                            ]
+
+                        payload, record = claim(keys=keys, args=[worker, started + 7200, build['key'], entry])
+                        _, number, superseded = json.loads(record)
+                        return payload, superseded or [], number
 
-                        repo = path.join(tmp, cfg['name'])
-                        if not path.exists(repo):
+                    claimed = 'claim:%s-%s' % (hints['cluster'], worker)
+                    payload, superseded, number = store.retry(_claim)
+                    js = json.loads(payload)
+
+                    #
+                    # - extract the various core parameters from the git push json
+                    #
+                    complete = 0
+                    state = {'ok': 1}
+                    cfg = js['repository']
+                    tag = cfg['full_name']
+                    sha = js['after']
+                    last = js['commits'][0]
+                    safe = tag.replace('/', '-')
+                    skipped = [commit for commit in superseded if commit != sha]
+                    log = ['- commit %s (%s)' % (sha[0:10], last['message'])]
+                    log += ['[skipped] commit %s (superseded by %s)' % (commit[0:10], sha[0:10]) for commit in skipped]
+                    steps = []
+                    timings = {}
+                    feed = store.retry(lambda: Feed(client, build['key']))
+                    for line in log:
+                        feed.write(line)
+
+                    tmp = path.join('/tmp', safe)
+                    mirror = path.join(mirrors, '%s.git' % safe)
+
+                    #
+                    # - hold a shared lock on the mirror for the whole build
+                    # - this prevents it from being evicted while we use it
+                    #
+                    hold = open('%s.lock' % mirror, 'a')
+                    fcntl.flock(hold, fcntl.LOCK_SH)
+                    try:
+
+                        try:
 
                             #
-                            # - the repo is not in our cache
-                            # - git clone it
+                            # - make sure the commit is available in our local mirror
+                            # - only what we are missing will be fetched
                             #
-                            os.makedirs(tmp)
-                            logger.info('cloning %s' % tag)
+                            tick = time.time()
                             url = 'https://%s' % cfg['git_url'][6:]
-                            code, _ = shell('git clone -b master --single-branch %s' % url, cwd=tmp)
-                            assert code == 0, 'unable to clone %s' % url
-                        else:
+                            _fetch(mirror, url, sha)
 
                             #
-                            # - the repo is already in there
-                            # - git pull
+                            # - if requested wipe out the work tree first
+                            # - the mirror is kept around
                             #
-                            shell('git pull', cwd=repo)
+                            if 'reset' in build and build['reset']:
+                                shutil.rmtree(tmp, ignore_errors=True)
+                                logger.info('wiped out %s' % tmp)
 
-                        #
-                        # - checkout the specified commit hash
-                        #
-                        logger.info('checkout @ %s' % sha[0:10])
-                        code, _ = shell('git checkout %s' % sha, cwd=repo)
-                        assert code == 0, 'unable to checkout %s (wrong credentials and/or git issue ?)' % sha[0:10]
+                            repo = path.join(tmp, cfg['name'])
+                            if not path.exists(path.join(repo, '.git', 'objects', 'info', 'alternates')):
+
+                                #
+                                # - the work tree is either missing or a standalone clone
+                                # - (re)create it as a local clone sharing the objects of our mirror (nothing is copied)
+                                #
+                                shutil.rmtree(tmp, ignore_errors=True)
+                                os.makedirs(tmp)
+                                logger.info('creating a work tree for %s' % tag)
+                                snippet = 'git clone -q --shared --no-checkout %s %s' % (mirror, cfg['name'])
+                                code, _ = shell(snippet, cwd=tmp)
+                                assert code == 0, 'unable to create a work tree from %s' % mirror
+
+                            #
+                            # - checkout the specified commit hash
+                            #
+                            logger.info('checkout @ %s' % sha[0:10])
+                            code, _ = shell('git checkout -q --force --detach %s' % sha, cwd=repo)
+                            assert code == 0, 'unable to checkout %s (wrong credentials and/or git issue ?)' % sha[0:10]
+                            timings['checkout'] = time.time() - tick
+
+                            #
+                            # - prep a little list of env. variable to pass down to the shell
+                            #   snippets we'll run
+                            #
+                            var = \
+                                {
+                                    'QUERY_URL': 'http://10.50.85.97:5000/status/%s' % tag,
+                                    'PRESETS': json.dumps(settings['presets']),
+                                    'HOST': os.environ['HOST'],
+                                    'COMMIT': sha,
+                                    'COMMIT_SHORT': sha[0:10],
+                                    'MESSAGE': last['message'],
+                                    'TAG': tag,
+                                    'TIMESTAMP': last['timestamp']
+                                }
+
+                            #
+                            # - go look for integration.yml
+                            # - if not found or invalid abort
+                            # - log the validation warnings if any
+                            #
+                            blocks, graph, warnings = _compile(repo, sha, plans)
+                            for warning in warnings:
+                                log += ['[warning] %s' % warning]
+                                feed.write(log[-1])
+
+                            #
+                            # - any block can specify which priority lane the repository should use
+                            # - store it in redis, the hook will use it for the subsequent builds
+                            #
+                            declared = [blk['priority'] for blk in blocks if 'priority' in blk]
+                            if declared:
+                                store.retry(lambda: client.set('priority:%s' % build['key'], declared[0]))
+                            else:
+                                store.retry(lambda: client.delete('priority:%s' % build['key']))
+                            lock = Lock()
+                            outputs = [{'log': [], 'abridged': [], 'ok': 1, 'seconds': 0} for _ in blocks]
+
+                            def _step(position):
+
+                                #
+                                # - execute each shell snippet of the block in order
+                                # - the block output is kept in its own slot to preserve the log ordering
+                                #   when several blocks run concurrently
+                                #
+                                blk = blocks[position]
+                                out = outputs[position]
+                                out['log'] += ['- %s' % blk['step']]
+                                begin = time.time()
+                                feed.write('- %s' % blk['step'])
+                                debug = blk['debug'] if 'debug' in blk else 0
+                                cwd = path.join(repo, blk['cwd']) if 'cwd' in blk else repo
+
+                                #
+                                # - if the block declares its inputs and they did not change since a prior successful
+                                #   run just replay what it logged back then
+                                #
+                                fingerprint = _inputs(tag, cwd, blk) if 'inputs' in blk and state['ok'] else None
+                                if fingerprint:
+                                    recorded = 'step:%s:%s' % (build['key'], fingerprint)
+                                    previous = store.retry(lambda: client.get(recorded))
+                                    if previous:
+                                        prior = json.loads(previous)
+                                        memento = '[cached] inputs unchanged since build #%d (%s)' % \
+                                                  (prior['build'], fingerprint[0:10])
+                                        feed.write(memento)
+                                        store.retry(lambda: client.expire(recorded, history['logs']))
+                                        passed = [line for line in prior['log'] if line.startswith('[passed]')]
+                                        with lock:
+                                            out['log'] += [memento] + prior['log']
+                                            out['abridged'] += passed
+                                        return
+
+                                #
+                                # - if the block declares a cache restore it first (e.g the dependencies we
+                                #   installed last time the files it is keyed on had the same content)
+                                #
+                                digest = None
+                                if 'cache' in blk:
+                                    spec = {key: value if isinstance(value, list) else [value]
+                                            for key, value in blk['cache'].items() if key in ['paths', 'key']}
+                                    digest = _fingerprint(tag, cwd, spec)
+                                    listed = ', '.join(spec['paths'])
+                                    if _restore(artifacts, digest, cwd):
+                                        memento = '[cache] restored %s (%s)' % (listed, digest[0:10])
+                                        digest = None
+                                    else:
+                                        memento = '[cache] no match for %s (%s)' % (listed, digest[0:10])
+                                    out['log'] += [memento]
+                                    feed.write(memento)
+
+                                for snippet in blk['shell']:
+
+                                    tick = time.time()
+                                    tokens = snippet.split(' ')
+                                    always = tokens[0] == 'no-skip'
+                                    if always or state['ok']:
+
+                                        #
+                                        # - if we used the 'no-skip' directive make sure we remove
+                                        #   it from the snippet
+                                        #
+                                        if always:
+                                            snippet = ' '.join(tokens[1:])
+
+                                        #
+                                        # - set the $OK and $LOG variables
+                                        # - make sure to use the abridged log to avoid exploding the maximum
+                                        #   env. variable capacity
+                                        #
+                                        with lock:
+                                            abridged = sum([slot['abridged'] for slot in outputs], [])
+                                            local = {'LOG': '\n'.join(abridged)}
+                                            if state['ok']:
+                                                local['OK'] = 'true'
+
+                                        #
+                                        # - if block specifies environment variables set them now
+                                        #
+                                        if 'env' in blk:
+                                            for key, value in blk['env'].items():
+                                                local[key] = str(value)
+
+                                        #
+                                        # - update the environment we'll pass to the shell
+                                        # - execute the snippet via a POpen()
+                                        #
+                                        local.update(var)
+                                        capped = snippet if len(snippet) < 32 else '%s...' % snippet[:64]
+                                        capped = capped.replace('\n', ' ')
+                                        logger.debug('running <%s>' % capped)
+                                        lines = []
+
+                                        def _emit(line):
+
+                                            #
+                                            # - stream each line as it comes
+                                            # - only keep them around if we are in debug mode
+                                            #
+                                            feed.write('[%s] . %s' % (blk['step'], line))
+                                            if debug:
+                                                lines.append(line)
+
+                                        code = _run(snippet, cwd, local, _emit)
+                                        lapse = int(time.time() - tick)
+                                        status = 'passed' if not code else 'failed'
+                                        memento = '[%s] %s (%d seconds, exit code %d)' % (status, capped, lapse, code)
+                                        logger.debug('<%s> -> %d' % (capped, code))
+                                        feed.write(memento)
+                                        with lock:
+                                            out['abridged'] += [memento]
+                                            out['log'] += [memento]
+                                            if debug:
+                                                out['log'] += ['[%s]   . %s' % (status, line) for line in lines]
+
+                                            #
+                                            # - switch the ok trigger off if the shell invocation failed
+                                            # - all subsequent shell executions will then be ignored unless
+                                            #   the 'no-skip' directive is used
+                                            #
+                                            if code != 0:
+                                                out['ok'] = 0
+                                                state['ok'] = 0
+
+                                    else:
+                                        out['log'] += ['[skipped] %s' % snippet]
+                                        feed.write('[skipped] %s' % snippet)
+
+                                #
+                                # - the cache was missing, save it now if the block went fine
+                                # - note the archive is content-addressed and never overwritten with anything different
+                                #
+                                if digest and out['ok'] and _save(artifacts, digest, cwd, spec['paths']):
+                                    memento = '[cache] saved %s (%s)' % (listed, digest[0:10])
+                                    out['log'] += [memento]
+                                    feed.write(memento)
+
+                                out['seconds'] = int(time.time() - begin)
+
+                                #
+                                # - remember the block went fine with those inputs (the record expires with the logs)
+                                #
+                                if fingerprint and out['ok'] and state['ok']:
+                                    logged = _truncate(out['log'][1:], history['lines'], history['width'])
+                                    record = json.dumps({'build': number, 'log': logged})
+                                    store.retry(lambda: client.set(recorded, record, ex=history['logs']))
+
+                            #
+                            # - run the blocks, independent ones being executed concurrently
+                            # - merge their output back in declaration order
+                            #
+                            try:
+                                _schedule(graph, _step, threads)
+                            finally:
+                                for blk, slot in zip(blocks, outputs):
+                                    log += slot['log']
+                                    steps += [{'step': blk['step'], 'ok': slot['ok'], 'seconds': slot['seconds']}]
+
+                            #
+                            # - we went through the whole thing
+                            #
+                            complete = 1
+
+                        except AssertionError as failure:
+
+                            log += ['* %s' % str(failure)]
+
+                        except IOError:
+
+                            log += ['* unable to load integration.yml (missing from the repo ?)']
+
+                        except YAMLError as failure:
+
+                            log += ['* invalid YAML syntax (%s)' % ' '.join(str(failure).split())]
+
+                        except Exception as failure:
+
+                            log += ['* unexpected condition -> %s' % diagnostic(failure)]
+
+                    finally:
 
                         #
-                        # - prep a little list of env. variable to pass down to the shell
-                        #   snippets we'll run
+                        # - make sure to cleanup our temporary directory
+                        # - update redis with
                         #
-                        var = \
+                        if not complete:
+                            logger.error('build interrupted (%s)' % log[-1])
+                            feed.write(log[-1])
+
+                        store.retry(feed.close)
+
+                        seconds = int(time.time() - started)
+                        capped = _truncate(log, history['lines'], history['width'])
+                        status = \
                             {
-                                'QUERY_URL': 'http://10.50.85.97:5000/status/%s' % tag,
-                                'PRESETS': json.dumps(settings['presets']),
-                                'HOST': os.environ['HOST'],
-                                'COMMIT': sha,
-                                'COMMIT_SHORT': sha[0:10],
-                                'MESSAGE': last['message'],
-                                'TAG': tag,
-                                'TIMESTAMP': last['timestamp']
+                                'ok': state['ok'] and complete,
+                                'build': number,
+                                'sha': sha,
+                                'skipped': skipped,
+                                'lines': len(log),
+                                'truncated': len(capped) != len(log),
+                                'started': int(started),
+                                'seconds': seconds,
+                                'steps': steps
                             }
 
-                        #
-                        # - go look for integration.yml
-                        # - if not found abort
-                        #
-                        with open(path.join(repo, 'integration.yml'), 'r') as f:
-                            yml = yaml.load(f)
+                        def _record():
 
-                        #
-                        # - the yaml can either be an array or a dict
-                        # - force it to an array for convenience
-                        # - otherwise loop and execute each shell snippet in order
-                        #
-                        js = yml if isinstance(yml, list) else [yml]
-                        for blk in js:
-                            log += ['- %s' % blk['step']]
-                            debug = blk['debug'] if 'debug' in blk else 0
-                            cwd = path.join(repo, blk['cwd']) if 'cwd' in blk else repo
-                            for snippet in blk['shell']:
-
-                                tick = time.time()
-                                tokens = snippet.split(' ')
-                                always = tokens[0] == 'no-skip'
-                                if always or ok:
-
-                                    #
-                                    # - if we used the 'no-skip' directive make sure we remove
-                                    #   it from the snippet
-                                    #
-                                    if always:
-                                        snippet = ' '.join(tokens[1:])
-
-                                    #
-                                    # - set the $OK and $LOG variables
-                                    # - make sure to use the abridged log to avoid exploding the maximum
-                                    #   env. variable capacity
-                                    #
-                                    local = {'LOG': '\n'.join(abridged)}
-                                    if ok:
-                                        local['OK'] = 'true'
-
-                                    #
-                                    # - if block specifies environment variables set them now
-                                    #
-                                    if 'env' in blk:
-                                        for key, value in blk['env'].items():
-                                            local[key] = str(value)
-
-                                    #
-                                    # - update the environment we'll pass to the shell
-                                    # - execute the snippet via a POpen()
-                                    #
-                                    local.update(var)
-                                    capped = snippet if len(snippet) < 32 else '%s...' % snippet[:64]
-                                    capped = capped.replace('\n', ' ')
-                                    logger.debug('running <%s>' % capped)
-                                    code, lines = shell(snippet, cwd=cwd, env=local)
-                                    lapse = int(time.time() - tick)
-                                    status = 'passed' if not code else 'failed'
-                                    memento = '[%s] %s (%d seconds, exit code %d)' % (status, capped, lapse, code)
-                                    abridged += [memento]
-                                    log += [memento]
-                                    logger.debug('<%s> -> %d' % (capped, code))
-                                    if debug:
-                                        log += ['[%s]   . %s' % (status, line) for line in lines]
-
-                                    #
-                                    # - switch the ok trigger off if the shell invocation failed
-                                    # - all subsequent shell executions will then be ignored unless
-                                    #   the 'no-skip' directive is used
-                                    #
-                                    if code != 0:
-                                        ok = 0
-
-                                else:
-                                    log += ['[skipped] %s' % snippet]
+                            #
+                            # - the status is a compact summary, the (capped) log is compressed and stored separately
+                            # - it is only replaced if ours is more recent (see publish)
+                            # - record the build under its number as well
+                            # - index it by time and only keep the last builds (see retire)
+                            # - its summary is kept longer than its log
+                            # - only the logs expire : redis may evict them when running out of memory
+                            # - all this goes in one pipeline (which is safe to retry)
+                            #
+                            summary = json.dumps(status)
+                            packed = _pack(capped)
+                            oldest = started - history['summaries']
+                            pipe = client.pipeline()
+                            keys = ['status:%s' % build['key'], 'status-log:%s' % build['key']]
+                            publish(keys=keys, args=[number, summary, packed, history['logs']], client=pipe)
+                            pipe.set('build:%s:%d' % (build['key'], number), summary)
+                            pipe.set('build-log:%s:%d' % (build['key'], number), packed, ex=history['logs'])
+                            pipe.zadd('history:%s' % build['key'], {number: started})
+                            args = [build['key'], oldest, history['depth']]
+                            retire(keys=['history:%s' % build['key']], args=args, client=pipe)
+                            pipe.execute()
 
-                        #
-                        # - we went through the whole thing
-                        #
-                        complete = 1
+                        def _account():
 
-                    except AssertionError as failure:
+                            #
+                            # - track how much build time each repository is using (see _greedy())
+                            # - counters can't be safely retried (we'd count twice) : this is done at most once
+                            #
+                            hour = int(time.time() / 3600)
+                            pipe = client.pipeline()
+                            args = ['usage:%s' % hints['cluster'], hour, seconds, tag]
+                            account(keys=['usage-hours:%s' % hints['cluster']], args=args, client=pipe)
 
-                        log += ['* %s' % str(failure)]
+                            #
+                            # - update our metrics (per cluster and per repository)
+                            # - we don't record per cluster aggregates : prometheus can sum the repositories up
+                            # - the queue wait time is only known if the hook stamped the build
+                            #
+                            outcome = 'passed' if status['ok'] else 'failed'
+                            specific = _labels(cluster=hints['cluster'], repo=tag)
+                            labels = _labels(cluster=hints['cluster'], repo=tag, outcome=outcome)
+                            _count(pipe, 'ci_builds_total', labels)
+                            _observe(pipe, 'ci_build_seconds', time.time() - started, specific)
+                            if 'queued' in build:
+                                wait = max(0, started - build['queued'])
+                                _observe(pipe, 'ci_queue_wait_seconds', wait, specific)
+                            if 'checkout' in timings:
+                                _observe(pipe, 'ci_checkout_seconds', timings['checkout'], specific)
+                            for step in steps:
+                                labels = _labels(cluster=hints['cluster'], repo=tag, step=step['step'])
+                                _observe(pipe, 'ci_step_seconds', step['seconds'], labels)
 
-                    except IOError:
+                            pipe.execute()
 
-                        log += ['* unable to load integration.yml (missing from the repo ?)']
+                        store.retry(_record)
+                        try:
+                            _account()
+                        except Exception as failure:
+                            logger.warning('unable to update our usage & metrics -> %s' % diagnostic(failure))
 
-                    except YAMLError as failure:
+                        logger.info('%s @ %s -> %s %d seconds' %
+                                    (tag, sha[0:10], 'ok' if status['ok'] else 'ko', seconds))
 
-                        log += ['* invalid YAML syntax']
+                        #
+                        # - release the mirror and trim the caches if we went over budget
+                        #
+                        hold.close()
+                        _evict(mirrors, budget)
+                        _prune(artifacts, allowance)
 
-                    except Exception as failure:
+                except Exception as failure:
 
-                        log += ['* unexpected condition -> %s' % diagnostic(failure)]
+                    logger.error('unexpected condition -> %s' % diagnostic(failure))
 
                 finally:
 
                     #
-                    # - make sure to cleanup our temporary directory
-                    # - update redis with
+                    # - release the work tree
+                    # - we are not busy anymore
+                    # - the job is done, remove it from our processing list (and forget its claim)
                     #
-                    if not complete:
-                        logger.error('build interrupted (%s)' % log[-1])
-
-                    seconds = int(time.time() - started)
-                    status = \
-                        {
-                            'ok': ok and complete,
-                            'sha': sha,
-                            'log': log,
-                            'seconds': seconds
-                        }
-                    client.set('status:%s' % build['key'], json.dumps(status))
-                    logger.info('%s @ %s -> %s %d seconds' % (tag, sha[0:10], 'ok' if status['ok'] else 'ko', seconds))
-
-            except Exception as failure:
-
-                logger.error('unexpected condition -> %s' % diagnostic(failure))
+                    if checkout:
+                        checkout.close()
+                        store.retry(lambda: client.zrem('busy:%s' % hints['cluster'], worker))
+                        store.retry(lambda: client.zrem('building', build['key']))
+                    store.retry(lambda: client.lrem(processing, 1, entry))
+                    store.retry(lambda: client.delete('claim:%s-%s' % (hints['cluster'], worker)))
+
+        #
+        # - fork our workers
+        # - if any of them dies shut the others down and exit (the pod will then restart us)
+        #
+        workers = [Process(target=_work, args=(slot,)) for slot in range(count)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        while all(worker.is_alive() for worker in workers):
+            time.sleep(1.0)
+
+        logger.error('one of our workers went down, shutting down')
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
 
     except Exception as failure:
 